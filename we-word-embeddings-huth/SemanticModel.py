@@ -1,6 +1,7 @@
 import tables
 import pickle
 import numpy as np
+from npp import normalize, blocked_xcorr
 
 import logging
 logger = logging.getLogger("SemanticModel")
@@ -176,19 +177,22 @@ class SemanticModel(object):
         self.data = gaussianize_mat(self.data.T).T
         logger.debug("Done gaussianizing..")
 
-    def zscore(self, axis=0):
+    def zscore(self, axis=0, inplace=False):
         """Z-scores either each feature (if axis is 0) or each word (if axis is 1).
-        If axis is None nothing will be Z-scored.
+        If axis is None nothing will be Z-scored. A new data matrix is allocated, unless
+        inplace is True and the data is floating point, in which case the current data
+        array (and any other reference to it) is overwritten to save memory.
         """
         if axis is None:
             logger.debug("Not Z-scoring..")
             return
         
         logger.debug("Z-scoring on axis %d"%axis)
+        out = self.data if inplace and np.issubdtype(self.data.dtype, np.floating) else None
         if axis==1:
-            self.data = zscore(self.data.T).T
+            self.data = normalize(self.data, axis=0, eps=1e-10, out=out)
         elif axis==0:
-            self.data = zscore(self.data)
+            self.data = normalize(self.data, axis=1, eps=1e-10, out=out)
     
     def rectify(self):
         """Rectifies the features.
@@ -219,11 +223,9 @@ class SemanticModel(object):
     def find_words_like_vec(self, vec, n=10, corr=True):
         """Finds the [n] words most like the given [vector].
         """
-        nwords = len(self.vocab)
         if corr:
-            corrs = np.nan_to_num([np.corrcoef(vec, self.data[:,wi])[1,0] for wi in range(nwords)])
-            scorrs = np.argsort(corrs)
-            words = list(reversed([(corrs[i], self.vocab[i]) for i in scorrs[-n:]]))
+            corrs, inds = blocked_xcorr(np.asarray(vec)[None], self.data.T, k=n)
+            words = [(c, self.vocab[i]) for c, i in zip(corrs[0], inds[0])]
         else:
             proj = np.nan_to_num(np.dot(vec, self.data))
             sproj = np.argsort(proj)
@@ -233,9 +235,12 @@ class SemanticModel(object):
     def find_words_like_vecs(self, vecs, n=10, corr=True, distance_cull=None):
         """Find the `n` words most like each vector in `vecs`.
         """
-        if corr:
-            from text.npp import xcorr
-            vproj = xcorr(vecs, self.data.T)
+        if corr and distance_cull is None:
+            ## Only the top n correlations of each vector are kept
+            corrs, inds = blocked_xcorr(vecs, self.data.T, k=n)
+            return np.array(self.vocab)[inds]
+        elif corr:
+            vproj = blocked_xcorr(vecs, self.data.T)
         else:
             vproj = np.dot(vecs, self.data)
 
@@ -313,14 +318,9 @@ def zscore(mat, return_unzvals=False):
     If [return_unzvals] is True, a matrix will be returned that can be used
     to return the z-scored values to their original state.
     """
-    zmat = np.empty(mat.shape)
-    unzvals = np.zeros((zmat.shape[0], 2))
-    for ri in range(mat.shape[0]):
-        unzvals[ri,0] = np.std(mat[ri,:])
-        unzvals[ri,1] = np.mean(mat[ri,:])
-        zmat[ri,:] = (mat[ri,:]-unzvals[ri,1]) / (1e-10+unzvals[ri,0])
+    zmat, (means, stds) = normalize(mat, axis=1, eps=1e-10, return_stats=True)
     
     if return_unzvals:
-        return zmat, unzvals
+        return zmat, np.column_stack([stds, means])
     
     return zmat
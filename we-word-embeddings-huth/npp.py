@@ -3,17 +3,17 @@
 import numpy as np
 
 ## Demean -- remove the mean from each column
-demean = lambda v: v-v.mean(0)
+demean = lambda v: normalize(v, scale=False)
 demean.__doc__ = """Removes the mean from each column of [v]."""
 dm = demean
 
 ## Z-score -- z-score each column
-zscore = lambda v: (v-v.mean(0))/v.std(0)
+zscore = lambda v: normalize(v)
 zscore.__doc__ = """Z-scores (standardizes) each column of [v]."""
 zs = zscore
 
 ## Rescale -- make each column have unit variance
-rescale = lambda v: v/v.std(0)
+rescale = lambda v: normalize(v, center=False)
 rescale.__doc__ = """Rescales each column of [v] to have unit variance."""
 rs = rescale
 
@@ -22,5 +22,198 @@ mcorr = lambda c1,c2: (zs(c1)*zs(c2)).mean(0)
 mcorr.__doc__ = """Matrix correlation. Find the correlation between each column of [c1] and the corresponding column of [c2]."""
 
 ## Cross corr -- find corr. between each row of c1 and EACH row of c2
-xcorr = lambda c1,c2: np.dot(zs(c1.T).T,zs(c2.T)) / (c1.shape[1])
+xcorr = lambda c1,c2: blocked_xcorr(c1, c2)
 xcorr.__doc__ = """Cross-column correlation. Finds the correlation between each row of [c1] and each row of [c2]."""
+
+def _float_dtype(dtype):
+    """Returns [dtype] if it is a floating point or complex type, and float64 otherwise.
+    """
+    return dtype if np.issubdtype(dtype, np.inexact) else np.dtype(np.float64)
+
+def _real_dtype(dtype):
+    """Returns the real type of the magnitudes of [dtype] values, e.g. float64 for complex128.
+    """
+    return np.finfo(dtype).dtype
+
+def _sumsq(mat, axis):
+    """Returns the sums of the squared magnitudes of the values in each column (if [axis] is 0) or row (if
+    [axis] is 1) of the 2D [mat]. Complex values are summed from their real and imaginary parts, so no
+    conjugate copy of [mat] is made.
+    """
+    subscripts = "ij,ij->j" if axis == 0 else "ij,ij->i"
+    if np.iscomplexobj(mat):
+        return np.einsum(subscripts, mat.real, mat.real) + np.einsum(subscripts, mat.imag, mat.imag)
+    return np.einsum(subscripts, mat, mat)
+
+def _chunked_views(mat, out, axis, chunk):
+    """Yields matching blocks of [mat] and [out], with the values that are normalized together along the
+    first axis of each block: the columns of [mat] if [axis] is 0, or its rows if [axis] is 1. If [chunk]
+    is given, blocks of that many columns (or rows) are yielded, so that a np.memmap is only read and
+    written one block at a time.
+    """
+    if axis == 1:
+        mat, out = mat.T, out.T
+    if mat.ndim == 1:
+        mat, out = mat[:,None], out[:,None]
+    nvec = mat.shape[1]
+    chunk = nvec if chunk is None else max(int(chunk), 1)
+    for start in range(0, nvec, chunk):
+        cols = slice(start, min(start + chunk, nvec))
+        yield cols, mat[:,cols], out[:,cols]
+
+def normalize(mat, axis=0, center=True, scale=True, stats=None, out=None, eps=0.0, chunk=None,
+              return_stats=False):
+    """Z-scores each column (if [axis] is 0) or each row (if [axis] is 1) of [mat], which can also be 1D.
+    If [center] is False the mean is not removed, and if [scale] is False the values are not divided by
+    the standard deviation (plus [eps]).
+
+    The result is written into [out] if it is given, which can be [mat] itself to normalize in place.
+    Otherwise a new array is allocated, with the type of [mat] if that is floating point or complex (and
+    float64 otherwise). The standard deviation of complex values is found from their squared magnitudes.
+    The mean is removed with one pass that writes straight into the output, and the standard deviation
+    is found from the centered output without further full-size temporaries. If [chunk] is given,
+    [chunk] columns (or rows) are done at a time, which keeps the working set small for large np.memmap
+    arrays.
+
+    If [stats] is given, it should be a (mean, std) pair from an earlier call (with [return_stats]), which
+    is used instead of the statistics of [mat], e.g. to normalize test data like training data. If
+    [return_stats] is True, (out, (mean, std)) is returned, and unnormalize(out, (mean, std)) gives [mat].
+    Arrays with more than two dimensions are normalized along their first axis.
+    """
+    dtype = _float_dtype(mat.dtype)
+    if out is None:
+        out = np.empty(mat.shape, dtype=dtype)
+    elif out.shape != mat.shape:
+        raise ValueError("out has shape %s, but mat has shape %s."%(out.shape, mat.shape))
+    
+    if mat.ndim > 2:
+        ## Normalize the columns of the (n x everything else) view
+        if axis != 0:
+            raise ValueError("Arrays with more than two dimensions can only be normalized along axis 0.")
+        flatout = out.reshape(out.shape[0], -1)
+        if not np.shares_memory(flatout, out):
+            raise ValueError("out should be contiguous.")
+        flat = normalize(mat.reshape(mat.shape[0], -1), center=center, scale=scale, out=flatout, eps=eps,
+                         chunk=chunk, return_stats=True,
+                         stats=None if stats is None else [np.ravel(s) for s in stats])[1]
+        if not return_stats:
+            return out
+        return out, tuple(s.reshape(mat.shape[1:]) for s in flat)
+    
+    nvec = mat.shape[axis-1] if mat.ndim > 1 else 1
+    if stats is None:
+        means = np.zeros((nvec,), dtype=dtype)
+        stds = np.ones((nvec,), dtype=_real_dtype(dtype))
+    else:
+        means = np.broadcast_to(np.asarray(stats[0], dtype=dtype), (nvec,))
+        stds = np.broadcast_to(np.asarray(stats[1], dtype=_real_dtype(dtype)), (nvec,))
+    
+    for cols, block, oblock in _chunked_views(mat, out, axis, chunk):
+        if stats is None and center:
+            means[cols] = block.mean(0, dtype=dtype)
+        if stats is None and scale and not center:
+            stds[cols] = np.real(block.std(0, dtype=dtype))
+        if center:
+            np.subtract(block, means[cols], out=oblock)
+        elif oblock is not block:
+            oblock[...] = block
+        if scale:
+            if stats is None and center:
+                ## The output is centered, so the variance is the mean of its squares
+                stds[cols] = np.sqrt(_sumsq(oblock, 0) / block.shape[0])
+            oblock /= stds[cols] + eps
+    
+    if isinstance(out, np.memmap):
+        out.flush()
+    if not return_stats:
+        return out
+    if mat.ndim == 1:
+        means, stds = means[0], stds[0]
+    return out, (means, stds)
+
+def unnormalize(mat, stats, axis=0, out=None, eps=0.0, chunk=None):
+    """Undoes normalize: multiplies each column (if [axis] is 0) or row (if [axis] is 1) of [mat] by the
+    standard deviation (plus [eps]) and adds the mean, from the (mean, std) pair [stats]. [out] and
+    [chunk] work as in normalize.
+    """
+    dtype = _float_dtype(mat.dtype)
+    if out is None:
+        out = np.empty(mat.shape, dtype=dtype)
+    nvec = mat.shape[axis-1] if mat.ndim > 1 else 1
+    means = np.broadcast_to(np.asarray(stats[0], dtype=dtype), (nvec,))
+    stds = np.broadcast_to(np.asarray(stats[1], dtype=_real_dtype(dtype)), (nvec,))
+    for cols, block, oblock in _chunked_views(mat, out, axis, chunk):
+        np.multiply(block, stds[cols] + eps, out=oblock)
+        oblock += means[cols]
+    if isinstance(out, np.memmap):
+        out.flush()
+    return out
+
+def centered_norms(mat, chunk=4096):
+    """Returns the norm of each row of [mat] after its mean is removed, i.e. its standard deviation times
+    the square root of its length. These can be found once for a fixed set of vectors (e.g. a vocabulary)
+    and passed to blocked_xcorr. [chunk] rows are done at a time. Rows that are constant up to rounding
+    error get a norm of 0.
+    """
+    dtype = _float_dtype(mat.dtype)
+    norms = np.empty((mat.shape[0],), dtype=_real_dtype(dtype))
+    for start in range(0, mat.shape[0], chunk):
+        block = np.asarray(mat[start:start+chunk], dtype=dtype)
+        cblock = normalize(block, axis=1, scale=False)
+        bnorms = np.sqrt(_sumsq(cblock, 1))
+        tiny = bnorms <= 100 * np.finfo(dtype).eps * np.sqrt(_sumsq(block, 1))
+        norms[start:start+chunk] = np.where(tiny, 0, bnorms)
+    return norms
+
+def blocked_xcorr(c1, c2, k=None, tile=1024, c2_norms=None):
+    """Cross-column correlation like xcorr: finds the correlation between each row of [c1] and each row of
+    [c2], reading [c2] in tiles of [tile] rows.
+
+    The rows of [c1] are centered and scaled to unit norm once. Because they have zero mean, their dot
+    products with the raw rows of [c2] only need to be divided by the centered norms of those rows, so
+    [c2] is never z-scored or copied. The norms can be given as [c2_norms] (see centered_norms) if they
+    have already been found.
+
+    If [k] is None, the dense (rows(c1) x rows(c2)) correlation matrix is returned. Otherwise only a running
+    top-[k] per row of [c1] is kept, updated with np.argpartition after each tile, so the peak memory is
+    one tile of correlations. (vals, inds) are then returned, each (rows(c1) x k), with the [k] largest
+    correlations of each row in decreasing order and the rows of [c2] they belong to. Correlations with
+    constant rows are nan in the dense matrix (as with xcorr), and 0 in the top-[k].
+    """
+    dtype = np.result_type(_float_dtype(c1.dtype), _float_dtype(c2.dtype))
+    z1 = normalize(c1, axis=1, scale=False)
+    z1 /= np.sqrt(_sumsq(z1, 1))[:,None]
+    if c2_norms is None:
+        c2_norms = centered_norms(c2, tile)
+    
+    n1, n2 = c1.shape[0], c2.shape[0]
+    if k is None:
+        out = np.empty((n1, n2), dtype=dtype)
+    else:
+        k = min(k, n2)
+        vals = np.full((n1, 0), -np.inf, dtype=dtype)
+        inds = np.zeros((n1, 0), dtype=int)
+    
+    for start in range(0, n2, tile):
+        stop = min(start + tile, n2)
+        tnorms = c2_norms[start:stop]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            corrs = np.where(tnorms > 0, np.dot(z1, c2[start:stop].T) / tnorms, np.nan)
+        if k is None:
+            out[:,start:stop] = corrs
+            continue
+        
+        ## Merge this tile with the current top k, and keep the top k of the union
+        corrs = np.nan_to_num(corrs, copy=False)
+        allvals = np.hstack([vals, corrs])
+        allinds = np.hstack([inds, np.broadcast_to(np.arange(start, stop), corrs.shape)])
+        if allvals.shape[1] > k:
+            best = np.argpartition(-allvals, k-1, axis=1)[:,:k]
+            allvals = np.take_along_axis(allvals, best, 1)
+            allinds = np.take_along_axis(allinds, best, 1)
+        vals, inds = allvals, allinds
+    
+    if k is None:
+        return out
+    order = np.argsort(-vals, axis=1, kind="stable")
+    return np.take_along_axis(vals, order, 1), np.take_along_axis(inds, order, 1)
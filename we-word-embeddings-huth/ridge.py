@@ -1,44 +1,98 @@
 #import scipy
 import numpy as np
 import logging
-from ridge_utils import mult_diag, counter
+from ridge_utils import mult_diag, counter, voxel_blocks, randomized_svd, read_columns, prefetch
+from ridge_utils import stage, staged, ColumnStack, DelayedMatrix
+from npp import normalize
 import random
 import itertools as itools
+import os
+import mmap
+import shutil
+import tempfile
+import contextlib
+import multiprocessing
+import concurrent.futures
+import sys
+import json
 
-zs = lambda v: (v-v.mean(0))/v.std(0) ## z-score function
+zs = lambda v: normalize(v) ## z-score function
 
 ridge_logger = logging.getLogger("ridge_corr")
 
-def ridge(stim, resp, alpha, singcutoff=1e-10, normalpha=False, logger=ridge_logger):
+def ridge(stim, resp, alpha, singcutoff=1e-10, normalpha=False, solver="svd", dtype=None,
+          out=None, voxel_chunk=None, max_memory=None, factored=False, rank=None, logger=ridge_logger):
     """Uses ridge regression to find a linear transformation of [stim] that approximates
     [resp]. The regularization parameter is [alpha].
 
     Parameters
     ----------
     stim : array_like, shape (T, N)
-        Stimuli with T time points and N features.
+        Stimuli with T time points and N features. Can also be a ridge_utils.DelayedMatrix, in which case
+        the "svd" solver uses the eigendecomposition of its Gram matrix and the delayed stimulus is never
+        formed.
     resp : array_like, shape (T, M)
-        Responses with T time points and M separate responses.
+        Responses with T time points and M separate responses. Can also be a lazy array such as an
+        np.memmap or a PyTables node (see ridge_utils.read_columns), which is read one block at a time.
     alpha : float or array_like, shape (M,)
         Regularization parameter. Can be given as a single value (which is applied to
         all M responses) or separate values for each response.
     normalpha : boolean
         Whether ridge parameters should be normalized by the largest singular value of stim. Good for
         comparing models with different numbers of parameters.
+    solver : "svd", "dual" or "auto", default "svd"
+        "svd" works with the SVD of the (T x N) training stimulus. "dual" works in the T x T kernel space:
+        it eigendecomposes stim times stim.T and never forms Vh, which is much cheaper when there are more
+        features than time points (e.g. many delays of a large feature space). Because the eigenvalues of
+        the kernel are the squared singular values, "dual" squares the conditioning of the problem, and on
+        ill-conditioned or rank-deficient stimuli its weights are less accurate than with "svd". "auto"
+        uses "dual" when N > T and the stimulus is float64, and "svd" otherwise.
+    dtype : numpy dtype or None
+        If given (e.g. np.float32), the stimuli and responses are converted to this type and every
+        intermediate result (SVD factors, UR and weights) is kept in it. float32 halves the memory use
+        and roughly doubles BLAS throughput. With float32, z-scored inputs and the "svd" solver the weights
+        typically agree with the float64 results to within 1e-4 of their largest magnitude. The "dual"
+        solver squares the conditioning, so with float32 its error can be far larger on ill-conditioned
+        stimuli. If None, no conversion is done and the results have the type of the stimulus
+        factorization.
+    out : array_like, shape (N, M), or None
+        Preallocated array (e.g. an np.memmap) that the weights are written into. If None a new array is
+        allocated.
+    voxel_chunk : int or None
+        If given, the weights are computed for blocks of this many responses at a time, so that only one
+        block of UR is held in memory besides the output.
+    max_memory : int or None
+        Approximate number of bytes the per-block working set may use. Used to choose [voxel_chunk] if
+        that is not given.
+    factored : boolean, default False
+        If True, the weights are returned as FactoredWeights: the (N x k) right singular vectors of stim
+        and a (k x M) matrix of coefficients, where k is the number of singular values kept. The dense
+        (N x M) weights are never formed.
+    rank : int or None
+        If given with [factored], the factored weights are truncated to this rank (see
+        FactoredWeights.truncate).
 
     Returns
     -------
-    wt : array_like, shape (N, M)
+    wt : array_like, shape (N, M), or FactoredWeights
         Linear regression weights.
     """
-    try:
-        U,S,Vh = np.linalg.svd(stim, full_matrices=False)
-    except np.linalg.LinAlgError:
-        logger.info("NORMAL SVD FAILED, trying more robust dgesvd..")
-        from text.regression.svd_dgesvd import svd_dgesvd
-        U,S,Vh = svd_dgesvd(stim, full_matrices=False)
-
-    UR = np.dot(U.T, np.nan_to_num(resp))
+    stim = _as_dtype(stim, dtype)
+    solver = _resolve_solver(solver, stim.shape, dtype=stim.dtype)
+    if solver == "dual":
+        U, S = _gram_eig(_kernel(stim), singcutoff, logger)
+    elif isinstance(stim, DelayedMatrix):
+        ## The delayed stimulus is never formed, so Vh and S come from its Gram matrix and U is not found
+        V, S = _gram_eig(_gram(stim), singcutoff, logger)
+        Vh, U = V.T, None
+    else:
+        with stage("svd", _svd_flops(*stim.shape)):
+            try:
+                U,S,Vh = np.linalg.svd(stim, full_matrices=False)
+            except np.linalg.LinAlgError:
+                logger.info("NORMAL SVD FAILED, trying more robust dgesvd..")
+                from text.regression.svd_dgesvd import svd_dgesvd
+                U,S,Vh = svd_dgesvd(stim, full_matrices=False)
     
     # Expand alpha to a collection if it's just a single value
     if isinstance(alpha, (float,int)):
@@ -50,21 +104,70 @@ def ridge(stim, resp, alpha, singcutoff=1e-10, normalpha=False, logger=ridge_log
         nalphas = alpha * norm
     else:
         nalphas = alpha
+    nalphas = np.asarray(nalphas, dtype=S.dtype)
+
+    # Group the responses by alpha once, and find the spectral shrinkage for each alpha (k x A)
+    ualphas, alphainds = np.unique(nalphas, return_inverse=True)
+    if solver == "dual":
+        ## Vh.T == stim.T U diag(1/S), so stim.T U diag(1/(S**2+a**2)) U.T resp gives the same weights
+        shrink = 1 / (S[:,None]**2 + ualphas**2)
+    else:
+        shrink = S[:,None] / (S[:,None]**2 + ualphas**2)
 
-    # Compute weights for each alpha
-    ualphas = np.unique(nalphas)
-    wt = np.zeros((stim.shape[1], resp.shape[1]))
-    for ua in ualphas:
-        selvox = np.nonzero(nalphas==ua)[0]
-        #awt = reduce(np.dot, [Vh.T, np.diag(S/(S**2+ua**2)), UR[:,selvox]])
-        awt = Vh.T.dot(np.diag(S/(S**2+ua**2))).dot(UR[:,selvox])
-        wt[:,selvox] = awt
+    nfeat, nvox = stim.shape[1], resp.shape[1]
+    if factored:
+        if out is not None:
+            raise ValueError("out can't be used with factored weights.")
+        ## The weights are Vh.T diag(S/(S**2+a**2)) U.T resp, and only the right-hand factor is stored
+        if solver == "dual":
+            Vh = (stim.T.dot(U) / S).T
+            shrink = S[:,None] * shrink
+        wt = np.zeros((S.shape[0], nvox), dtype=S.dtype)
+    elif out is None:
+        wt = np.zeros((nfeat, nvox), dtype=S.dtype)
+    elif out.shape != (nfeat, nvox):
+        raise ValueError("out has shape %s, but the weights have shape %s."%(out.shape, (nfeat, nvox)))
+    else:
+        wt = out
+
+    # Compute weights for each block of responses, scaling each column of UR by its own alpha's shrinkage
+    blocks = voxel_blocks(nvox, 2 * S.shape[0] + nfeat, voxel_chunk=voxel_chunk, max_memory=max_memory,
+                          itemsize=S.dtype.itemsize)
+    ## The next block of responses is read while the weights for the current block are computed
+    if U is None:
+        ## U.T resp == S^-1 Vh stim.T resp
+        getUR = lambda vox: np.dot(Vh, stim.T.dot(np.nan_to_num(read_columns(resp, vox, dtype=dtype)))) / S[:,None]
+        getUR = staged("UR", getUR, 2 * nfeat * (stim.shape[0] + S.shape[0]))
+    else:
+        getUR = lambda vox: np.dot(U.T, np.nan_to_num(read_columns(resp, vox, dtype=dtype)))
+        getUR = staged("UR", getUR, 2 * stim.shape[0] * S.shape[0])
+    if factored:
+        wtflops = S.shape[0]
+    elif solver == "dual":
+        wtflops = 2 * (stim.shape[0] + nfeat) * S.shape[0]
+    else:
+        wtflops = 2 * nfeat * S.shape[0]
+    for vox, UR in zip(blocks, prefetch(getUR, blocks)):
+        with stage("weights", wtflops * UR.shape[1]):
+            UR *= shrink[:,alphainds[vox]]
+            if factored:
+                wt[:,vox] = UR
+            elif solver == "dual":
+                wt[:,vox] = stim.T.dot(U.dot(UR))
+            else:
+                wt[:,vox] = Vh.T.dot(UR)
 
+    if factored:
+        wt = FactoredWeights(Vh.T, wt)
+        return wt if rank is None else wt.truncate(rank)
+    if isinstance(wt, np.memmap):
+        wt.flush()
     return wt
     
 
 def ridge_corr_pred(Rstim, Pstim, Rresp, Presp, valphas, normalpha=False,
-                    singcutoff=1e-10, use_corr=True, logger=ridge_logger):
+                    singcutoff=1e-10, use_corr=True, voxel_chunk=None, max_memory=None,
+                    solver="svd", svd_rank=None, svd_energy=None, dtype=None, logger=ridge_logger):
     """Uses ridge regression to find a linear transformation of [Rstim] that approximates [Rresp],
     then tests by comparing the transformation of [Pstim] to [Presp]. Returns the correlation 
     between predicted and actual [Presp], without ever computing the regression weights.
@@ -78,9 +181,11 @@ def ridge_corr_pred(Rstim, Pstim, Rresp, Presp, valphas, normalpha=False,
         Test stimuli with TP time points and N features. Each feature should be Z-scored across time.
     Rresp : array_like, shape (TR, M)
         Training responses with TR time points and M responses (voxels, neurons, what-have-you).
-        Each response should be Z-scored across time.
+        Each response should be Z-scored across time. Can also be a lazy array such as an np.memmap or
+        a PyTables node (see ridge_utils.read_columns). Lazy responses are read one voxel block at a
+        time, and the next block is read in a background thread while the current one is scored.
     Presp : array_like, shape (TP, M)
-        Test responses with TP time points and M responses.
+        Test responses with TP time points and M responses. Can be a lazy array, like Rresp.
     valphas : list or array_like, shape (M,)
         Ridge parameter for each voxel.
     normalpha : boolean
@@ -103,6 +208,36 @@ def ridge_corr_pred(Rstim, Pstim, Rresp, Presp, valphas, normalpha=False,
         this can make a big difference -- highly regularized solutions will have very small norms and
         will thus explain very little variance while still leading to high correlations, as correlation
         is scale-free while R**2 is not.
+    voxel_chunk : int or None
+        If given, the responses are processed in blocks of this many voxels. The SVD of Rstim is computed
+        once and reused for every block, so peak memory scales with the block size instead of M. The
+        results match the unchunked computation up to floating-point rounding.
+    max_memory : int or None
+        Approximate number of bytes the per-block working set (response blocks, predictions and
+        correlation temporaries) may use. Used to choose [voxel_chunk] if that is not given.
+    solver : "svd", "dual", "auto" or "randomized", default "svd"
+        "svd" works with the SVD of the (T x N) training stimulus. "dual" works in the T x T kernel space:
+        it eigendecomposes Rstim times Rstim.T and never forms Vh, which is much cheaper when there are more
+        features than time points (e.g. many delays of a large feature space). Because the eigenvalues of
+        the kernel are the squared singular values, "dual" squares the conditioning of the problem and is
+        less accurate than "svd" on ill-conditioned stimuli. "auto" uses "dual" when N > T and the stimulus
+        is float64, and "svd" otherwise.
+        "randomized" approximates the SVD with a randomized range finder that keeps only [svd_rank]
+        singular values, or as many as are needed to keep [svd_energy] of the stimulus energy. This trades
+        a controlled approximation for speed when the spectrum of Rstim decays quickly.
+    svd_rank : int or None
+        Number of singular values kept by the "randomized" solver.
+    svd_energy : float in (0..1] or None
+        Fraction of the stimulus energy (sum of squared singular values) that the "randomized" solver
+        should keep. If [svd_rank] is also given it is used as the starting rank. The discarded energy
+        is logged.
+    dtype : numpy dtype or None
+        If given (e.g. np.float32), the stimuli and responses are converted to this type and every
+        intermediate result (SVD factors, UR, PVh, predictions and correlation buffers) is kept in it.
+        float32 halves the memory use and roughly doubles BLAS throughput. With float32, z-scored inputs
+        and the "svd" solver the correlations typically agree with the float64 results to within 1e-4
+        (the "dual" solver can be much less accurate in float32, see [solver]). If None, no conversion is
+        done and the results have the type of the stimulus factorization.
 
     Returns
     -------
@@ -110,61 +245,28 @@ def ridge_corr_pred(Rstim, Pstim, Rresp, Presp, valphas, normalpha=False,
         The correlation between each predicted response and each column of Presp.
     
     """
-    ## Calculate SVD of stimulus matrix
-    logger.info("Doing SVD...")
-    try:
-        U,S,Vh = np.linalg.svd(Rstim, full_matrices=False)
-    except np.linalg.LinAlgError:
-        logger.info("NORMAL SVD FAILED, trying more robust dgesvd..")
-        from text.regression.svd_dgesvd import svd_dgesvd
-        U,S,Vh = svd_dgesvd(Rstim, full_matrices=False)
-
-    ## Truncate tiny singular values for speed
-    origsize = S.shape[0]
-    ngoodS = np.sum(S > singcutoff)
-    nbad = origsize-ngoodS
-    U = U[:,:ngoodS]
-    S = S[:ngoodS]
-    Vh = Vh[:ngoodS]
-    logger.info("Dropped %d tiny singular values.. (U is now %s)"%(nbad, str(U.shape)))
-
-    ## Normalize alpha by the LSV norm
-    norm = S[0]
-    logger.info("Training stimulus has LSV norm: %0.03f"%norm)
-    if normalpha:
-        nalphas = valphas * norm
-    else:
-        nalphas = valphas
+    ## Factorize the stimulus matrix, and precompute the test stimulus times Vh.T for speed
+    Rstim = _as_dtype(Rstim, dtype)
+    Pstim = _as_dtype(Pstim, dtype)
+    U, S, PVh = _factor_stim(Rstim, Pstim, singcutoff, solver, logger, svd_rank, svd_energy)
 
-    ## Precompute some products for speed
-    UR = np.dot(U.T, Rresp) ## Precompute this matrix product for speed
-    PVh = np.dot(Pstim, Vh.T) ## Precompute this matrix product for speed
-    
-    #Prespnorms = np.apply_along_axis(np.linalg.norm, 0, Presp) ## Precompute test response norms
-    zPresp = zs(Presp)
-    #Prespvar = Presp.var(0)
-    Prespvar_actual = Presp.var(0)
-    Prespvar = (np.ones_like(Prespvar_actual) + Prespvar_actual) / 2.0
-    logger.info("Average difference between actual & assumed Prespvar: %0.3f" % (Prespvar_actual - Prespvar).mean())
-
-    ualphas = np.unique(nalphas)
-    corr = np.zeros((Rresp.shape[1],))
-    for ua in ualphas:
-        selvox = np.nonzero(nalphas==ua)[0]
-        alpha_pred = PVh.dot(np.diag(S/(S**2+ua**2))).dot(UR[:,selvox])
-
-        if use_corr:
-            corr[selvox] = (zPresp[:,selvox] * zs(alpha_pred)).mean(0)
-        else:
-            resvar = (Presp[:,selvox] - alpha_pred).var(0)
-            Rsq = 1 - (resvar / Prespvar)
-            corr[selvox] = np.sqrt(np.abs(Rsq)) * np.sign(Rsq)
+    ## Split the responses into voxel blocks that are scored one after another
+    nvox = Rresp.shape[1]
+    blocks = voxel_blocks(nvox, Rresp.shape[0] + S.shape[0] + 4 * Presp.shape[0],
+                          voxel_chunk=voxel_chunk, max_memory=max_memory,
+                          itemsize=_itemsize(Rresp, dtype))
+    logger.info("Scoring %d responses in %d block(s).."%(nvox, len(blocks)))
 
-    return corr
+    getblock = lambda vox: (np.dot(U.T, read_columns(Rresp, vox, dtype=dtype)),
+                            read_columns(Presp, vox, dtype=dtype))
+    getblock = staged("UR", getblock, 2 * Rresp.shape[0] * S.shape[0])
+    return _ridge_corr_pred_blocks(S, PVh, getblock, blocks, nvox, valphas, normalpha, use_corr, logger)
 
 
 def ridge_corr(Rstim, Pstim, Rresp, Presp, alphas, normalpha=False, corrmin=0.2,
-               singcutoff=1e-10, use_corr=True, logger=ridge_logger):
+               singcutoff=1e-10, use_corr=True, voxel_chunk=None, max_memory=None,
+               solver="svd", svd_rank=None, svd_energy=None, dtype=None, method="direct",
+               logger=ridge_logger):
     """Uses ridge regression to find a linear transformation of [Rstim] that approximates [Rresp],
     then tests by comparing the transformation of [Pstim] to [Presp]. This procedure is repeated
     for each regularization parameter alpha in [alphas]. The correlation between each prediction and
@@ -179,9 +281,11 @@ def ridge_corr(Rstim, Pstim, Rresp, Presp, alphas, normalpha=False, corrmin=0.2,
         Test stimuli with TP time points and N features. Each feature should be Z-scored across time.
     Rresp : array_like, shape (TR, M)
         Training responses with TR time points and M responses (voxels, neurons, what-have-you).
-        Each response should be Z-scored across time.
+        Each response should be Z-scored across time. Can also be a lazy array such as an np.memmap or
+        a PyTables node (see ridge_utils.read_columns). Lazy responses are read one voxel block at a
+        time, and the next block is read in a background thread while the current one is scored.
     Presp : array_like, shape (TP, M)
-        Test responses with TP time points and M responses.
+        Test responses with TP time points and M responses. Can be a lazy array, like Rresp.
     alphas : list or array_like, shape (A,)
         Ridge parameters to be tested. Should probably be log-spaced. np.logspace(0, 3, 20) works well.
     normalpha : boolean
@@ -204,6 +308,42 @@ def ridge_corr(Rstim, Pstim, Rresp, Presp, alphas, normalpha=False, corrmin=0.2,
         this can make a big difference -- highly regularized solutions will have very small norms and
         will thus explain very little variance while still leading to high correlations, as correlation
         is scale-free while R**2 is not.
+    voxel_chunk : int or None
+        If given, the responses are processed in blocks of this many voxels. The SVD of Rstim is computed
+        once and reused for every block, so peak memory scales with the block size instead of M. The
+        results match the unchunked computation up to floating-point rounding.
+    max_memory : int or None
+        Approximate number of bytes the per-block working set (response blocks, predictions and
+        correlation temporaries) may use. Used to choose [voxel_chunk] if that is not given.
+    solver : "svd", "dual", "auto" or "randomized", default "svd"
+        "svd" works with the SVD of the (T x N) training stimulus. "dual" works in the T x T kernel space:
+        it eigendecomposes Rstim times Rstim.T and never forms Vh, which is much cheaper when there are more
+        features than time points (e.g. many delays of a large feature space). Because the eigenvalues of
+        the kernel are the squared singular values, "dual" squares the conditioning of the problem and is
+        less accurate than "svd" on ill-conditioned stimuli. "auto" uses "dual" when N > T and the stimulus
+        is float64, and "svd" otherwise.
+        "randomized" approximates the SVD with a randomized range finder that keeps only [svd_rank]
+        singular values, or as many as are needed to keep [svd_energy] of the stimulus energy. This trades
+        a controlled approximation for speed when the spectrum of Rstim decays quickly.
+    svd_rank : int or None
+        Number of singular values kept by the "randomized" solver.
+    svd_energy : float in (0..1] or None
+        Fraction of the stimulus energy (sum of squared singular values) that the "randomized" solver
+        should keep. If [svd_rank] is also given it is used as the starting rank. The discarded energy
+        is logged.
+    dtype : numpy dtype or None
+        If given (e.g. np.float32), the stimuli and responses are converted to this type and every
+        intermediate result (SVD factors, UR, PVh, predictions and correlation buffers) is kept in it.
+        float32 halves the memory use and roughly doubles BLAS throughput. With float32, z-scored inputs
+        and the "svd" solver the correlations typically agree with the float64 results to within 1e-4
+        (the "dual" solver can be much less accurate in float32, see [solver]). If None, no conversion is
+        done and the results have the type of the stimulus factorization.
+    method : "direct" or "spectral", default "direct"
+        How the correlations for the different alphas are computed. "direct" forms the TP x M prediction
+        for every alpha, costing A*TP*k*M for k retained singular values. "spectral" precomputes a few
+        k-dimensional cross-products of the test stimulus and responses and scores every alpha from those,
+        costing A*k*k*M, which is much faster when k is small compared to TP. Both give the same results
+        up to floating-point rounding.
 
     Returns
     -------
@@ -211,14 +351,55 @@ def ridge_corr(Rstim, Pstim, Rresp, Presp, alphas, normalpha=False, corrmin=0.2,
         The correlation between each predicted response and each column of Presp for each alpha.
     
     """
-    ## Calculate SVD of stimulus matrix
+    ## Factorize the stimulus matrix, and precompute the test stimulus times Vh.T for speed
+    Rstim = _as_dtype(Rstim, dtype)
+    Pstim = _as_dtype(Pstim, dtype)
+    U, S, PVh = _factor_stim(Rstim, Pstim, singcutoff, solver, logger, svd_rank, svd_energy)
+
+    ## Split the responses into voxel blocks that are scored one after another
+    nvox = Rresp.shape[1]
+    blocks = voxel_blocks(nvox, Rresp.shape[0] + S.shape[0] + 4 * Presp.shape[0],
+                          voxel_chunk=voxel_chunk, max_memory=max_memory,
+                          itemsize=_itemsize(Rresp, dtype))
+    logger.info("Scoring %d responses in %d block(s).."%(nvox, len(blocks)))
+
+    getblock = lambda vox: (np.dot(U.T, read_columns(Rresp, vox, dtype=dtype)),
+                            read_columns(Presp, vox, dtype=dtype))
+    getblock = staged("UR", getblock, 2 * Rresp.shape[0] * S.shape[0])
+    return _ridge_corr_blocks(S, PVh, getblock, blocks, nvox, alphas, normalpha, corrmin, use_corr, logger,
+                              method=method)
+
+
+def _as_dtype(arr, dtype):
+    """Returns [arr] as an array of the given [dtype], or unchanged if [dtype] is None. A DelayedMatrix
+    stays a DelayedMatrix.
+    """
+    if dtype is None:
+        return arr
+    if isinstance(arr, DelayedMatrix):
+        return arr.astype(dtype)
+    return np.asarray(arr, dtype=dtype)
+
+
+def _itemsize(arr, dtype):
+    """Returns the size in bytes of one element of [arr] after it is converted to [dtype].
+    """
+    return (arr.dtype if dtype is None else np.dtype(dtype)).itemsize
+
+
+def _stim_svd(stim, singcutoff, logger):
+    """Computes the SVD of [stim] and drops singular values/vectors smaller than [singcutoff].
+    """
+    if isinstance(stim, DelayedMatrix):
+        raise TypeError("The SVD of a DelayedMatrix can't be found without forming it, use its Gram matrix.")
     logger.info("Doing SVD...")
-    try:
-        U,S,Vh = np.linalg.svd(Rstim, full_matrices=False)
-    except np.linalg.LinAlgError:
-        logger.info("NORMAL SVD FAILED, trying more robust dgesvd..")
-        from text.regression.svd_dgesvd import svd_dgesvd
-        U,S,Vh = svd_dgesvd(Rstim, full_matrices=False)
+    with stage("svd", _svd_flops(*stim.shape)):
+        try:
+            U,S,Vh = np.linalg.svd(stim, full_matrices=False)
+        except np.linalg.LinAlgError:
+            logger.info("NORMAL SVD FAILED, trying more robust dgesvd..")
+            from text.regression.svd_dgesvd import svd_dgesvd
+            U,S,Vh = svd_dgesvd(stim, full_matrices=False)
 
     ## Truncate tiny singular values for speed
     origsize = S.shape[0]
@@ -228,7 +409,43 @@ def ridge_corr(Rstim, Pstim, Rresp, Presp, alphas, normalpha=False, corrmin=0.2,
     S = S[:ngoodS]
     Vh = Vh[:ngoodS]
     logger.info("Dropped %d tiny singular values.. (U is now %s)"%(nbad, str(U.shape)))
+    return U, S, Vh
 
+
+def _svd_flops(m, n):
+    """Returns a rough estimate of the number of floating-point operations in the thin SVD of an
+    (m x n) matrix (bidiagonalization and accumulating the singular vectors).
+    """
+    k = min(m, n)
+    return 6 * m * n * k + 8 * k**3
+
+
+def _kernel(stim):
+    """Returns the (T x T) kernel matrix [stim] times [stim].T, recorded as the "kernel" stage.
+    """
+    with stage("kernel", 2 * stim.shape[0]**2 * stim.shape[1]):
+        if isinstance(stim, DelayedMatrix):
+            return stim.kernel()
+        return np.dot(stim, stim.T)
+
+
+def _gram(stim):
+    """Returns the (N x N) Gram matrix [stim].T times [stim].
+    """
+    if isinstance(stim, DelayedMatrix):
+        return stim.gram()
+    return np.dot(stim.T, stim)
+
+
+def _ridge_corr_blocks(S, PVh, getblock, blocks, nvox, alphas, normalpha, corrmin, use_corr, logger,
+                       method="direct"):
+    """Scores every alpha in [alphas] for each block of responses in [blocks], given the singular values
+    [S] of the training stimulus and the product [PVh] of the test stimulus with Vh.T.
+    getblock(vox) should return U.T times the training responses, and the test responses, for the voxels
+    in slice [vox]. It is called for the next block in a background thread while the current block
+    is scored. [method] is "direct" or "spectral" (see ridge_corr).
+    Returns the (A, M) array of correlations that ridge_corr computes.
+    """
     ## Normalize alpha by the LSV norm
     norm = S[0]
     logger.info("Training stimulus has LSV norm: %0.03f"%norm)
@@ -236,46 +453,68 @@ def ridge_corr(Rstim, Pstim, Rresp, Presp, alphas, normalpha=False, corrmin=0.2,
         nalphas = alphas * norm
     else:
         nalphas = alphas
+    nalphas = np.asarray(nalphas, dtype=S.dtype)
 
-    ## Precompute some products for speed
-    UR = np.dot(U.T, Rresp) ## Precompute this matrix product for speed
-    PVh = np.dot(Pstim, Vh.T) ## Precompute this matrix product for speed
-    
-    #Prespnorms = np.apply_along_axis(np.linalg.norm, 0, Presp) ## Precompute test response norms
-    zPresp = zs(Presp)
-    #Prespvar = Presp.var(0)
-    Prespvar_actual = Presp.var(0)
-    Prespvar = (np.ones_like(Prespvar_actual) + Prespvar_actual) / 2.0
-    logger.info("Average difference between actual & assumed Prespvar: %0.3f" % (Prespvar_actual - Prespvar).mean())
-    Rcorrs = [] ## Holds training correlations for each alpha
-    for na, a in zip(nalphas, alphas):
-        #D = np.diag(S/(S**2+a**2)) ## Reweight singular vectors by the ridge parameter 
-        D = S / (S ** 2 + na ** 2) ## Reweight singular vectors by the (normalized?) ridge parameter
-        
-        pred = np.dot(mult_diag(D, PVh, left=False), UR) ## Best (1.75 seconds to prediction in test)
-        # pred = np.dot(mult_diag(D, np.dot(Pstim, Vh.T), left=False), UR) ## Better (2.0 seconds to prediction in test)
-        
-        # pvhd = reduce(np.dot, [Pstim, Vh.T, D]) ## Pretty good (2.4 seconds to prediction in test)
-        # pred = np.dot(pvhd, UR)
-        
-        # wt = reduce(np.dot, [Vh.T, D, UR]).astype(dtype) ## Bad (14.2 seconds to prediction in test)
-        # wt = reduce(np.dot, [Vh.T, D, U.T, Rresp]).astype(dtype) ## Worst
-        # pred = np.dot(Pstim, wt) ## Predict test responses
+    if method == "spectral":
+        ## Center the spectral components of the test predictions and find their covariance once,
+        ## so that each alpha can be scored without forming its predictions
+        ntest = PVh.shape[0]
+        PVhc = PVh - PVh.mean(0)
+        PVhcov = np.dot(PVhc.T, PVhc) / ntest
+    elif method != "direct":
+        raise ValueError("Unknown method %r, should be 'direct' or 'spectral'." % (method,))
 
-        if use_corr:
-            #prednorms = np.apply_along_axis(np.linalg.norm, 0, pred) ## Compute predicted test response norms
-            #Rcorr = np.array([np.corrcoef(Presp[:,ii], pred[:,ii].ravel())[0,1] for ii in range(Presp.shape[1])]) ## Slowly compute correlations
-            #Rcorr = np.array(np.sum(np.multiply(Presp, pred), 0)).squeeze()/(prednorms*Prespnorms) ## Efficiently compute correlations
-            Rcorr = (zPresp * zs(pred)).mean(0)
-        else:
-            ## Compute variance explained
-            resvar = (Presp - pred).var(0)
-            Rsq = 1 - (resvar / Prespvar)
-            Rcorr = np.sqrt(np.abs(Rsq)) * np.sign(Rsq)
-            
-        Rcorr[np.isnan(Rcorr)] = 0
-        Rcorrs.append(Rcorr)
-        
+    Rcorrs = np.zeros((len(nalphas), nvox), dtype=S.dtype) ## Holds training correlations for each alpha
+    vardiff = 0.0
+    for vox, (UR, Presp) in zip(blocks, prefetch(getblock, blocks)):
+
+        #Prespnorms = np.apply_along_axis(np.linalg.norm, 0, Presp) ## Precompute test response norms
+        zPresp = zs(Presp)
+        #Prespvar = Presp.var(0)
+        Prespvar_actual = Presp.var(0)
+        Prespvar = (np.ones_like(Prespvar_actual) + Prespvar_actual) / 2.0
+        vardiff += (Prespvar_actual - Prespvar).sum()
+
+        if method == "spectral":
+            ## Covariance of each spectral component with each z-scored test response
+            PZ = np.dot(PVhc.T, zPresp) / ntest
+            Prespstd = np.sqrt(Prespvar_actual)
+
+        for ai, na in enumerate(nalphas):
+            #D = np.diag(S/(S**2+a**2)) ## Reweight singular vectors by the ridge parameter 
+            D = S / (S ** 2 + na ** 2) ## Reweight singular vectors by the (normalized?) ridge parameter
+
+            if method == "spectral":
+                ## The prediction is PVh D UR, so its moments are quadratic forms in D UR (k x M),
+                ## which costs k**2 M per alpha instead of TP k M
+                with stage("prediction", (2 * S.shape[0] + 4) * S.shape[0] * UR.shape[1]):
+                    DUR = mult_diag(D, UR)
+                    predcov = (DUR * PZ).sum(0) ## Covariance of each prediction with the z-scored response
+                    predvar = (np.dot(PVhcov, DUR) * DUR).sum(0) ## Variance of each prediction
+                if use_corr:
+                    Rcorr = predcov / np.sqrt(predvar)
+                else:
+                    resvar = Prespvar_actual + predvar - 2 * predcov * Prespstd
+            else:
+                with stage("prediction", 2 * PVh.shape[0] * S.shape[0] * UR.shape[1]):
+                    pred = np.dot(mult_diag(D, PVh, left=False), UR) ## Best (1.75 seconds to prediction in test)
+
+                with stage("scoring", 8 * pred.size):
+                    if use_corr:
+                        Rcorr = (zPresp * zs(pred)).mean(0)
+                    else:
+                        resvar = (Presp - pred).var(0)
+
+            if not use_corr:
+                ## Compute variance explained
+                Rsq = 1 - (resvar / Prespvar)
+                Rcorr = np.sqrt(np.abs(Rsq)) * np.sign(Rsq)
+
+            Rcorr[np.isnan(Rcorr)] = 0
+            Rcorrs[ai,vox] = Rcorr
+
+    logger.info("Average difference between actual & assumed Prespvar: %0.3f" % (vardiff / nvox))
+    for a, Rcorr in zip(alphas, Rcorrs):
         log_template = "Training: alpha=%0.3f, mean corr=%0.5f, max corr=%0.5f, over-under(%0.2f)=%d"
         log_msg = log_template % (a,
                                   np.mean(Rcorr),
@@ -283,13 +522,177 @@ def ridge_corr(Rstim, Pstim, Rresp, Presp, alphas, normalpha=False, corrmin=0.2,
                                   corrmin,
                                   (Rcorr>corrmin).sum()-(-Rcorr>corrmin).sum())
         logger.info(log_msg)
-    
+
     return Rcorrs
 
 
+def _ridge_corr_pred_blocks(S, PVh, getblock, blocks, nvox, valphas, normalpha, use_corr, logger):
+    """Computes the test correlation for each block of responses in [blocks] using the separate alpha
+    that each voxel is assigned in [valphas]. See _ridge_corr_blocks for the other arguments.
+    Returns the (M,) array of correlations that ridge_corr_pred computes.
+    """
+    ## Normalize alpha by the LSV norm
+    norm = S[0]
+    logger.info("Training stimulus has LSV norm: %0.03f"%norm)
+    if normalpha:
+        nalphas = valphas * norm
+    else:
+        nalphas = valphas
+    nalphas = np.asarray(nalphas, dtype=S.dtype)
+
+    corr = np.zeros((nvox,), dtype=S.dtype)
+    vardiff = 0.0
+    for vox, (UR, Presp) in zip(blocks, prefetch(getblock, blocks)):
+
+        #Prespnorms = np.apply_along_axis(np.linalg.norm, 0, Presp) ## Precompute test response norms
+        zPresp = zs(Presp)
+        #Prespvar = Presp.var(0)
+        Prespvar_actual = Presp.var(0)
+        Prespvar = (np.ones_like(Prespvar_actual) + Prespvar_actual) / 2.0
+        vardiff += (Prespvar_actual - Prespvar).sum()
+
+        bnalphas = nalphas[vox]
+        bcorr = np.zeros((bnalphas.shape[0],), dtype=S.dtype)
+        for ua in np.unique(bnalphas):
+            selvox = np.nonzero(bnalphas==ua)[0]
+            with stage("prediction", 2 * PVh.shape[0] * S.shape[0] * len(selvox)):
+                alpha_pred = PVh.dot(np.diag(S/(S**2+ua**2))).dot(UR[:,selvox])
+
+            with stage("scoring", 8 * alpha_pred.size):
+                if use_corr:
+                    bcorr[selvox] = (zPresp[:,selvox] * zs(alpha_pred)).mean(0)
+                else:
+                    resvar = (Presp[:,selvox] - alpha_pred).var(0)
+                    Rsq = 1 - (resvar / Prespvar[selvox])
+                    bcorr[selvox] = np.sqrt(np.abs(Rsq)) * np.sign(Rsq)
+        corr[vox] = bcorr
+
+    logger.info("Average difference between actual & assumed Prespvar: %0.3f" % (vardiff / nvox))
+    return corr
+
+
+def ridge_permutation_test(Rstim, Pstim, Rresp, Presp, valphas, nperms=1000, chunklen=10, normalpha=False,
+                           singcutoff=1e-10, use_corr=True, batch_size=100, voxel_chunk=None, max_memory=None,
+                           solver="svd", svd_rank=None, svd_energy=None, seed=None, dtype=None,
+                           logger=ridge_logger):
+    """Tests whether the prediction performance that ridge_corr_pred finds for each response is better than
+    chance, by refitting the model to training responses whose time points are block-shuffled.
+
+    The training responses are split into consecutive chunks of [chunklen] time points and the chunks are
+    shuffled, which breaks their relationship with the stimulus while keeping their autocorrelation within
+    each chunk. The factorization of Rstim and the test stimulus product PVh do not depend on the responses,
+    so they are computed once. Each permutation only needs a new U.T Rresp, which is found for
+    [batch_size] permutations at once with a single matrix product.
+
+    Parameters
+    ----------
+    Rstim, Pstim, Rresp, Presp, valphas, normalpha, singcutoff, use_corr
+        As in ridge_corr_pred. Rresp and Presp can be lazy arrays.
+    nperms : int, default 1000
+        Number of permutations.
+    chunklen : int, default 10
+        Length of the chunks of training time points that are shuffled. This should be a few times longer
+        than the autocorrelation of the responses.
+    batch_size : int, default 100
+        Number of permutations that are scored together.
+    voxel_chunk : int or None
+        If given, the responses are processed in blocks of this many voxels.
+    max_memory : int or None
+        Approximate number of bytes the per-block working set (which grows with [batch_size]) may use.
+        Used to choose [voxel_chunk] if that is not given. If neither is given, the blocks are chosen so
+        that the working set of a batch is about as large as Rresp.
+    solver, svd_rank, svd_energy, dtype
+        As in ridge_corr_pred.
+    seed : int or None
+        Seed for the permutations.
+
+    Returns
+    -------
+    corrs : array_like, shape (M,)
+        The correlation between each predicted response and each column of Presp, as in ridge_corr_pred.
+    pvalues : array_like, shape (M,)
+        The fraction of permutations (counting the unpermuted data as one) that scored at least as well as
+        [corrs], for each response.
+    nullmax : array_like, shape (nperms,)
+        The best score across all responses for each permutation. The family-wise corrected p-value of a
+        response is (np.sum(nullmax >= corr) + 1) / (nperms + 1).
+    """
+    Rstim = _as_dtype(Rstim, dtype)
+    Pstim = _as_dtype(Pstim, dtype)
+    U, S, PVh = _factor_stim(Rstim, Pstim, singcutoff, solver, logger, svd_rank, svd_energy)
+    ntrain, nvox = Rresp.shape
+    ntest, nS = PVh.shape
+    
+    if normalpha:
+        nalphas = valphas * S[0]
+    else:
+        nalphas = valphas
+    ualphas, alphainds = np.unique(np.asarray(nalphas, dtype=S.dtype), return_inverse=True)
+    shrink = S[:,None] / (S[:,None]**2 + ualphas**2)
+    
+    ## Each batch of permutations is drawn from its own seed, so that it is the same for every voxel block
+    nbatches = -(-nperms // batch_size)
+    batchseeds = np.random.RandomState(seed).randint(2**31 - 1, size=nbatches)
+    chunks = [np.arange(start, min(start + chunklen, ntrain)) for start in range(0, ntrain, chunklen)]
+    def permutations(bi):
+        rng = np.random.RandomState(batchseeds[bi])
+        nbperms = min(batch_size, nperms - bi * batch_size)
+        return np.array([np.concatenate([chunks[ci] for ci in rng.permutation(len(chunks))])
+                         for pi in range(nbperms)]).T ## (TR x nbperms)
+    
+    def score(UR, zPresp, bPresp, Prespvar, vox):
+        """Scores the (k x P x m) or (k x m) U.T Rresp products [UR] of the voxels in [vox]."""
+        DUR = UR * shrink[:,alphainds[vox]].reshape((nS,) + (1,) * (UR.ndim - 2) + (-1,))
+        with stage("prediction", 2 * ntest * DUR.size):
+            pred = np.dot(PVh, DUR.reshape(nS, -1)).reshape((ntest,) + DUR.shape[1:])
+        with stage("scoring", 8 * pred.size):
+            if use_corr:
+                Rcorr = (zPresp * zs(pred)).mean(0)
+            else:
+                Rsq = 1 - (bPresp - pred).var(0) / Prespvar
+                Rcorr = np.sqrt(np.abs(Rsq)) * np.sign(Rsq)
+        return np.nan_to_num(Rcorr)
+    
+    corrs = np.zeros((nvox,), dtype=S.dtype)
+    counts = np.zeros((nvox,), dtype=int)
+    nullmax = np.full((nperms,), -np.inf)
+    blockrows = (2 * ntrain + nS + 4 * ntest) * min(batch_size, nperms) + ntrain + 4 * ntest
+    if voxel_chunk is None and max_memory is None:
+        ## A single block would need batch_size times the memory of Rresp for each batch
+        voxel_chunk = max(1, ntrain * nvox // blockrows)
+    blocks = voxel_blocks(nvox, blockrows, voxel_chunk=voxel_chunk, max_memory=max_memory,
+                          itemsize=_itemsize(Rresp, dtype))
+    logger.info("Testing %d responses with %d permutations in %d block(s).."%(nvox, nperms, len(blocks)))
+    getblock = lambda vox: (read_columns(Rresp, vox, dtype=dtype), read_columns(Presp, vox, dtype=dtype))
+    for vox, (Rblock, bPresp) in zip(blocks, prefetch(getblock, blocks)):
+        zPresp = zs(bPresp)
+        Prespvar = (1 + bPresp.var(0)) / 2.0 ## like ridge_corr_pred
+        with stage("UR", 2 * ntrain * nS * Rblock.shape[1]):
+            UR = np.dot(U.T, Rblock)
+        corrs[vox] = score(UR, zPresp, bPresp, Prespvar, vox)
+        
+        for bi in range(nbatches):
+            perms = permutations(bi)
+            ## U.T times the permuted responses, for every permutation in the batch at once (k x P x m)
+            with stage("UR", 2 * ntrain * nS * perms.shape[1] * Rblock.shape[1]):
+                PUR = np.dot(U.T, Rblock[perms].reshape(ntrain, -1)).reshape(nS, perms.shape[1], -1)
+            permcorrs = score(PUR, zPresp[:,None], bPresp[:,None], Prespvar, vox)
+            counts[vox] += (permcorrs >= corrs[vox]).sum(0)
+            permslice = slice(bi * batch_size, bi * batch_size + perms.shape[1])
+            nullmax[permslice] = np.maximum(nullmax[permslice], permcorrs.max(1))
+    
+    pvalues = (counts + 1.0) / (nperms + 1.0)
+    logger.info("%d of %d responses have p < 0.05.."%((pvalues < 0.05).sum(), nvox))
+    return corrs, pvalues, nullmax
+
+
 def bootstrap_ridge(Rstim, Rresp, Pstim, Presp, alphas, nboots, chunklen, nchunks,
                     corrmin=0.2, joined=None, singcutoff=1e-10, normalpha=False, single_alpha=False,
-                    use_corr=True, return_wt=True, logger=ridge_logger):
+                    use_corr=True, return_wt=True, voxel_chunk=None, max_memory=None,
+                    n_jobs=1, blas_threads=None, seed=None, tmpdir=None, checkpoint_dir=None, solver="svd",
+                    svd_rank=None, svd_energy=None, dtype=None, method="direct", selection="bootstrap",
+                    factored=False, wt_rank=None, return_model=False, delays=None, stim_stats=None,
+                    resp_stats=None, logger=ridge_logger):
     """Uses ridge regression with a bootstrapped held-out set to get optimal alpha values for each response.
     [nchunks] random chunks of length [chunklen] will be taken from [Rstim] and [Rresp] for each regression
     run.  [nboots] total regression runs will be performed.  The best alpha value for each response will be
@@ -302,14 +705,20 @@ def bootstrap_ridge(Rstim, Rresp, Pstim, Presp, alphas, nboots, chunklen, nchunk
     ----------
     Rstim : array_like, shape (TR, N)
         Training stimuli with TR time points and N features. Each feature should be Z-scored across time.
+        Can also be a ridge_utils.DelayedMatrix, so that the delayed stimulus is never formed. With the
+        "svd" or "auto" [solver] the "gram" solver is then used, and its Gram matrix is built from shifted
+        views.
     Rresp : array_like, shape (TR, M)
         Training responses with TR time points and M different responses (voxels, neurons, what-have-you).
-        Each response should be Z-scored across time.
+        Each response should be Z-scored across time. Can also be a lazy array such as an np.memmap or a
+        PyTables node (see ridge_utils.read_columns), which is read one voxel block at a time (see
+        [voxel_chunk]), with the next block read in a background thread.
     Pstim : array_like, shape (TP, N)
         Test stimuli with TP time points and N features. Each feature should be Z-scored across time.
+        Can also be a DelayedMatrix.
     Presp : array_like, shape (TP, M)
         Test responses with TP time points and M different responses. Each response should be Z-scored across
-        time.
+        time. Can be a lazy array, like Rresp.
     alphas : list or array_like, shape (A,)
         Ridge parameters that will be tested. Should probably be log-spaced. np.logspace(0, 3, 20) works well.
     nboots : int
@@ -353,11 +762,96 @@ def bootstrap_ridge(Rstim, Rresp, Pstim, Presp, alphas, nboots, chunklen, nchunk
         alpha parameter for each voxel. However, for very large models this can lead to memory issues.
         If false, this function will _not_ compute weights, but will still compute prediction performance
         on the prediction dataset (Pstim, Presp).
+    voxel_chunk : int or None, default None
+        If given, the responses are processed in blocks of this many voxels. The SVD of each bootstrap's
+        training stimulus is computed once and reused for every block, and only one block of the held-in
+        and held-out responses is copied at a time, so peak memory scales with the block size instead of
+        M. The results match the unchunked computation up to floating-point rounding.
+    max_memory : int or None, default None
+        Approximate number of bytes the per-block working set may use. Used to choose [voxel_chunk] if
+        that is not given.
+    n_jobs : int, default 1
+        Number of worker processes the bootstrap samples are spread across (-1 uses every core). Rstim and
+        Rresp are shared with the workers through memory-mapped files instead of being pickled, and each
+        worker writes its correlations straight into a shared memory-mapped output. The workers are spawned,
+        so they re-import the calling script: a script that uses n_jobs > 1 must keep its top-level code
+        under an if __name__ == "__main__": guard. If the workers cannot be started (an unguarded script,
+        or code piped through stdin) a warning is logged and the samples are run serially.
+    blas_threads : int or None, default None
+        Number of BLAS/OpenMP threads each worker process may use. Defaults to the number of cores divided
+        by [n_jobs], so that the workers do not oversubscribe the machine.
+    seed : int or None, default None
+        Seed for selecting the held-out chunks. All held-out sets are drawn before any bootstrap is run,
+        so [valinds] only depends on the seed (or the state of the `random` module if this is None) and
+        not on [n_jobs].
+    tmpdir : str or None, default None
+        Directory in which the memory-mapped files shared with the worker processes are created. Defaults
+        to the system temporary directory. Only used if [n_jobs] is greater than 1.
+    checkpoint_dir : str or None, default None
+        If given, the held-out sets and each bootstrap sample's correlations are stored in memory-mapped
+        files in this directory as soon as they are found, and bootstrap_corrs is returned as a view of
+        them. If the directory already holds a checkpoint from an interrupted run with the same
+        [alphas], [nboots], responses, [chunklen], [nchunks], [seed], [use_corr], [normalpha],
+        [singcutoff], [solver], [svd_rank], [svd_energy] and [dtype], its held-out sets are used and the
+        finished bootstrap samples are skipped. A checkpoint from a run with other settings is rejected
+        with a ValueError. The best alphas are found by reading the stored correlations one sample at a
+        time.
+    solver : "svd", "dual", "auto", "randomized" or "gram", default "svd"
+        How the held-in stimulus of each bootstrap sample is factorized. "svd" takes the SVD of the held-in
+        rows of Rstim, "dual" works in the kernel space, and "randomized" uses an approximate truncated SVD
+        controlled by [svd_rank] and [svd_energy] (see ridge_corr); "auto" picks "svd" or "dual" as in
+        ridge_corr. "gram" computes Rstim.T Rstim (N x N) and Rstim.T
+        Rresp (N x M) once, subtracts the contributions of the held-out chunks, and gets each bootstrap's
+        spectrum from an N x N eigendecomposition. When TR is much larger than N this is far cheaper per
+        bootstrap, at the cost of keeping the N x M cross-product in memory. Because the eigenvalues of the
+        Gram matrix are the squared singular values, singular values below about sqrt(machine epsilon) times
+        the largest are less accurate than with "svd". With "randomized" and "gram" the final fit on the
+        entire training set still uses the exact "svd" solver.
+    svd_rank, svd_energy : int or None, float or None
+        Rank or energy target of the "randomized" solver, see ridge_corr.
+    dtype : numpy dtype or None, default None
+        If given (e.g. np.float32), the stimuli and responses are converted to this type and every
+        intermediate result (SVD factors, UR, PVh, predictions, weights and correlation buffers) is kept in it.
+        float32 halves the memory use and roughly doubles BLAS throughput. With float32, z-scored inputs
+        and the "svd" solver the correlations typically agree with the float64 results to within 1e-4
+        (the "dual" solver can be much less accurate in float32, see [solver]). If None, no conversion is
+        done and the results have the type of the stimulus factorization.
+    method : "direct" or "spectral", default "direct"
+        How the bootstrap correlations for the different alphas are computed, see ridge_corr.
+    selection : "bootstrap", "gcv" or "loco", default "bootstrap"
+        How the alphas are scored. "bootstrap" uses the [nboots] random held-out sets described above.
+        "gcv" and "loco" instead score every alpha in closed form from a single factorization of Rstim, at
+        about the cost of one bootstrap sample. "gcv" uses generalized cross-validation, and its scores are
+        the GCV estimate of the held-out R**2 (given as sqrt(|R**2|) * sign(R**2), like with use_corr=False).
+        "loco" uses leave-one-chunk-out cross-validation: Rstim and Rresp are split into consecutive chunks
+        of length [chunklen], and each chunk is predicted from all of the others, which respects temporal
+        autocorrelation in a way leave-one-out (chunklen=1) does not. Its scores are correlations or R**2
+        between the held-out predictions and Rresp, depending on [use_corr]. With either, [nboots],
+        [nchunks], [n_jobs] and [method] are not used, the "randomized" and "gram" solvers are replaced by
+        the exact "svd" solver, and bootstrap_corrs has a single sample.
+    factored : boolean, default False
+        If True, the weights are returned as FactoredWeights (see ridge), which take (N + M) k numbers instead
+        of N M, where k is at most min(TR, N). The test set is predicted from the factors directly.
+    wt_rank : int or None, default None
+        If given with [factored], the weights are truncated to this rank before the test set is predicted,
+        so the correlations are those of the truncated weights (see FactoredWeights.truncate).
+    return_model : boolean, default False
+        If True, a RidgeModel holding the weights (dense or factored), [delays], [stim_stats], [resp_stats]
+        and the selected alphas is returned in place of wt, so that new stimuli can be predicted without
+        redoing make_delayed. Needs [return_wt].
+    delays : list of int or None, default None
+        The delays that were used to build Rstim and Pstim with make_delayed, for the RidgeModel. If None,
+        Rstim is taken to be undelayed.
+    stim_stats, resp_stats : tuples of array_like, or None
+        The (mean, std) of each undelayed stimulus feature and of each response, for the RidgeModel (see
+        RidgeModel.__init__). If None, new stimuli are taken to be z-scored already, and the predictions are
+        left z-scored.
     
     Returns
     -------
-    wt : array_like, shape (N, M)
-        If [return_wt] is True, regression weights for N features and M responses. If [return_wt] is False, [].
+    wt : array_like, shape (N, M), FactoredWeights or RidgeModel
+        If [return_wt] is True, regression weights for N features and M responses (or a RidgeModel holding
+        them, if [return_model] is True). If [return_wt] is False, [].
     corrs : array_like, shape (M,)
         Validation set correlations. Predicted responses for the validation set are obtained using the regression
         weights: pred = np.dot(Pstim, wt), and then the correlation between each predicted response and each 
@@ -366,64 +860,112 @@ def bootstrap_ridge(Rstim, Rresp, Pstim, Presp, alphas, nboots, chunklen, nchunk
         The regularization coefficient (alpha) selected for each voxel using bootstrap cross-validation.
     bootstrap_corrs : array_like, shape (A, M, B)
         Correlation between predicted and actual responses on randomly held out portions of the training set,
-        for each of A alphas, M voxels, and B bootstrap samples.
+        for each of A alphas, M voxels, and B bootstrap samples. With [selection] "gcv" or "loco", the closed
+        form scores, with B = 1.
     valinds : array_like, shape (TH, B)
-        The indices of the training data that were used as "validation" for each bootstrap sample.
+        The indices of the training data that were used as "validation" for each bootstrap sample. Empty
+        with [selection] "gcv" or "loco".
     """
+    if return_model and not return_wt:
+        raise ValueError("return_model needs return_wt.")
+    if solver in ("svd", "auto") and isinstance(Rstim, DelayedMatrix):
+        ## Only the Gram matrix of a DelayedMatrix can be found without forming it
+        solver = "gram"
+    if isinstance(Rstim, DelayedMatrix) and selection == "bootstrap" and solver != "gram" and nboots > 0:
+        ## The other solvers factorize the held-in rows of Rstim, which would form them
+        raise ValueError("Bootstrapping a DelayedMatrix stimulus needs solver 'gram' (or 'svd'), not %r."
+                         % (solver,))
     nresp, nvox = Rresp.shape
-    valinds = [] # Will hold the indices into the validation data for each bootstrap
-    
-    Rcmats = []
-    for bi in counter(range(nboots), countevery=1, total=nboots):
-        logger.info("Selecting held-out test set..")
-        allinds = range(nresp)
-        indchunks = list(zip(*[iter(allinds)]*chunklen))
-        random.shuffle(indchunks)
-        heldinds = list(itools.chain(*indchunks[:nchunks]))
-        notheldinds = list(set(allinds)-set(heldinds))
-        valinds.append(heldinds)
-        
-        RRstim = Rstim[notheldinds,:]
-        PRstim = Rstim[heldinds,:]
-        RRresp = Rresp[notheldinds,:]
-        PRresp = Rresp[heldinds,:]
-        
-        # Run ridge regression using this test set
-        Rcmat = ridge_corr(RRstim, PRstim, RRresp, PRresp, alphas,
-                           corrmin=corrmin, singcutoff=singcutoff,
-                           normalpha=normalpha, use_corr=use_corr,
-                           logger=logger)
-        
-        Rcmats.append(Rcmat)
+    Rstim = _as_dtype(Rstim, dtype)
+    Pstim = _as_dtype(Pstim, dtype)
     
-    # Find best alphas
-    if nboots>0:
-        allRcorrs = np.dstack(Rcmats)
+    if selection in ("gcv", "loco"):
+        # Score every alpha in closed form from a single factorization of Rstim instead of bootstrapping
+        fitsolver = "svd" if solver in ("gram", "randomized") else solver
+        allRcorrs = _closed_form_scores(Rstim, Rresp, alphas, selection, chunklen, singcutoff, normalpha,
+                                        use_corr, fitsolver, voxel_chunk, max_memory, dtype, logger)[:,:,None]
+        valinds = []
+    elif selection != "bootstrap":
+        raise ValueError("Unknown selection %r, should be 'bootstrap', 'gcv' or 'loco'." % (selection,))
     else:
-        allRcorrs = None
+        # Select all of the held-out sets up front, so that they do not depend on how the bootstraps are run
+        rng = random if seed is None else random.Random(seed)
+        splits = [_bootstrap_split(nresp, chunklen, nchunks, rng, logger) for bi in range(nboots)]
+        if checkpoint_dir is not None and nboots > 0:
+            ## Finished bootstraps are stored on disk, and skipped when an interrupted run is restarted
+            settings = dict(nresp=int(nresp), chunklen=int(chunklen), nchunks=int(nchunks),
+                            seed=None if seed is None else int(seed), use_corr=bool(use_corr),
+                            normalpha=bool(normalpha), singcutoff=float(singcutoff), solver=solver,
+                            svd_rank=None if svd_rank is None else int(svd_rank),
+                            svd_energy=None if svd_energy is None else float(svd_energy),
+                            dtype=None if dtype is None else np.dtype(dtype).name)
+            Rcorrs, done, splits = _open_checkpoint(checkpoint_dir, splits, alphas, nvox, dtype, settings, logger)
+        else:
+            Rcorrs, done = None, None
+        valinds = [heldinds for heldinds, notheldinds in splits] # The indices into the validation data for each bootstrap
+        todo = [bi for bi in range(nboots) if done is None or not done[bi]]
+    
+        if solver == "gram":
+            logger.info("Precomputing Gram matrix and stimulus-response cross-products..")
+            gram = _gram_cross(Rstim, Rresp, voxel_chunk, max_memory, dtype)
+            fitsolver = "svd" ## the final fit and prediction do not use the Gram matrix
+        else:
+            _resolve_solver(solver, Rstim.shape, ("svd", "dual", "randomized")) ## check that the solver exists
+            gram = None
+            fitsolver = "svd" if solver == "randomized" else solver
+    
+        bootargs = dict(alphas=alphas, corrmin=corrmin, singcutoff=singcutoff, normalpha=normalpha,
+                        use_corr=use_corr, voxel_chunk=voxel_chunk, max_memory=max_memory, solver=solver,
+                        svd_rank=svd_rank, svd_energy=svd_energy, dtype=dtype, method=method, logger=logger)
+        if n_jobs == -1:
+            n_jobs = os.cpu_count()
+    
+        Rcmats = None
+        if n_jobs > 1 and len(todo) > 1:
+            Rcmats = _parallel_bootstraps(Rstim, Rresp, gram, splits, todo, n_jobs, blas_threads, tmpdir,
+                                          bootargs, out=Rcorrs, done=done, logger=logger)
+            if Rcmats is None and done is not None:
+                todo = [bi for bi in todo if not done[bi]]
+        if Rcmats is None:
+            Rcmats = []
+            for bi in counter(todo, countevery=1, total=len(todo)):
+                heldinds, notheldinds = splits[bi]
+                with stage("bootstrap"):
+                    Rcmat = _bootstrap_corr(Rstim, Rresp, heldinds, notheldinds, gram=gram, **bootargs)
+                if Rcorrs is None:
+                    Rcmats.append(Rcmat)
+                else:
+                    Rcorrs[bi] = Rcmat
+                    _mark_done(Rcorrs, done, bi)
+    
+        # Find best alphas
+        if nboots>0:
+            allRcorrs = np.dstack(Rcmats) if Rcorrs is None else np.moveaxis(Rcorrs, 0, 2)
+        else:
+            allRcorrs = None
     
     if not single_alpha:
-        if nboots==0:
+        if allRcorrs is None:
             raise ValueError("You must run at least one cross-validation step to assign "
                              "different alphas to each response.")
         
         logger.info("Finding best alpha for each voxel..")
+        meanbootcorrs = _mean_bootstrap_corrs(allRcorrs)
         if joined is None:
             # Find best alpha for each voxel
-            meanbootcorrs = allRcorrs.mean(2)
             bestalphainds = np.argmax(meanbootcorrs, 0)
             valphas = alphas[bestalphainds]
         else:
             # Find best alpha for each group of voxels
             valphas = np.zeros((nvox,))
             for jl in joined:
-                # Mean across voxels in the set, then mean across bootstraps
-                jcorrs = allRcorrs[:,jl,:].mean(1).mean(1)
+                # Mean across bootstraps, then mean across voxels in the set
+                jcorrs = meanbootcorrs[:,jl].mean(1)
                 bestalpha = np.argmax(jcorrs)
                 valphas[jl] = alphas[bestalpha]
     else:
         logger.info("Finding single best alpha..")
-        if nboots==0:
+        if allRcorrs is None:
             if len(alphas)==1:
                 bestalphaind = 0
                 bestalpha = alphas[0]
@@ -432,7 +974,7 @@ def bootstrap_ridge(Rstim, Rresp, Pstim, Presp, alphas, nboots, chunklen, nchunk
                                  "to choose best overall alpha, or only supply one"
                                  "possible alpha value.")
         else:
-            meanbootcorr = allRcorrs.mean(2).mean(1)
+            meanbootcorr = _mean_bootstrap_corrs(allRcorrs).mean(1)
             bestalphaind = np.argmax(meanbootcorr)
             bestalpha = alphas[bestalphaind]
         
@@ -442,27 +984,1484 @@ def bootstrap_ridge(Rstim, Rresp, Pstim, Presp, alphas, nboots, chunklen, nchunk
     if return_wt:
         # Find weights
         logger.info("Computing weights for each response using entire training set..")
-        wt = ridge(Rstim, Rresp, valphas, singcutoff=singcutoff, normalpha=normalpha)
+        wt = ridge(Rstim, Rresp, valphas, singcutoff=singcutoff, normalpha=normalpha, solver=fitsolver,
+                   dtype=dtype, voxel_chunk=voxel_chunk, max_memory=max_memory, factored=factored,
+                   rank=wt_rank, logger=logger)
+        if factored:
+            ## Project the test stimuli onto the left factor once, rather than for each block
+            Pstim = Pstim.dot(wt.left)
 
-        # Predict responses on prediction set
+        # Predict responses on prediction set and find prediction correlations, one voxel block at a time
         logger.info("Predicting responses for predictions set..")
-        pred = np.dot(Pstim, wt)
-
-        # Find prediction correlations
-        nnpred = np.nan_to_num(pred)
-        if use_corr:
-            corrs = np.nan_to_num(np.array([np.corrcoef(Presp[:,ii], nnpred[:,ii].ravel())[0,1]
-                                            for ii in range(Presp.shape[1])]))
-        else:
-            resvar = (Presp-pred).var(0)
-            Rsqs = 1 - (resvar / Presp.var(0))
-            corrs = np.sqrt(np.abs(Rsqs)) * np.sign(Rsqs)
+        corrs = np.zeros((nvox,), dtype=wt.dtype)
+        blocks = voxel_blocks(nvox, 3 * Pstim.shape[0], voxel_chunk=voxel_chunk, max_memory=max_memory,
+                              itemsize=_itemsize(Presp, dtype))
+        getblock = lambda vox: read_columns(Presp, vox, dtype=dtype)
+        for vox, bPresp in zip(blocks, prefetch(getblock, blocks)):
+            with stage("prediction", 2 * Pstim.shape[0] * Pstim.shape[1] * bPresp.shape[1]):
+                pred = Pstim.dot(wt.right[:,vox] if factored else wt[:,vox])
+            nnpred = np.nan_to_num(pred)
+            if use_corr:
+                corrs[vox] = np.nan_to_num((zs(bPresp) * zs(nnpred)).mean(0))
+            else:
+                resvar = (bPresp-pred).var(0)
+                Rsqs = 1 - (resvar / bPresp.var(0))
+                corrs[vox] = np.sqrt(np.abs(Rsqs)) * np.sign(Rsqs)
 
+        if return_model:
+            stim_mean, stim_std = (None, None) if stim_stats is None else stim_stats
+            resp_mean, resp_std = (None, None) if resp_stats is None else resp_stats
+            wt = RidgeModel(wt, (0,) if delays is None else delays, stim_mean, stim_std,
+                            resp_mean, resp_std, valphas)
         return wt, corrs, valphas, allRcorrs, valinds
     else:
         # get correlations for prediction dataset directly
         corrs = ridge_corr_pred(Rstim, Pstim, Rresp, Presp, valphas, 
                                 normalpha=normalpha, use_corr=use_corr,
-                                logger=logger, singcutoff=singcutoff)
+                                logger=logger, singcutoff=singcutoff,
+                                voxel_chunk=voxel_chunk, max_memory=max_memory, solver=fitsolver,
+                                dtype=dtype)
+
+        return [], corrs, valphas, allRcorrs, valinds
+
+
+def bootstrap_ridge_multi(Rstim, Rresps, Pstim, Presps, alphas, nboots, chunklen, nchunks, joined=None,
+                          single_alpha=False, **kwargs):
+    """Runs bootstrap_ridge for several subjects (or other sets of responses) that share the same stimuli.
+    The held-out sets, the factorization of Rstim for each bootstrap sample, the test stimulus products
+    and the final fit's factorization are only computed once, and the responses of every subject are
+    streamed through them block by block (see [voxel_chunk]) as if they were one large response matrix.
+    The alphas are still chosen separately for each subject.
+
+    Parameters
+    ----------
+    Rstim, Pstim : array_like
+        Training and test stimuli shared by every subject, as in bootstrap_ridge.
+    Rresps, Presps : lists of array_like
+        Training (TR x M_s) and test (TP x M_s) responses of each subject. They can be lazy arrays.
+    joined : list of lists of lists, or None
+        If given, one list of joined voxel groups (see bootstrap_ridge) for each subject, with voxel
+        indices into that subject's responses.
+    single_alpha : boolean, default False
+        If True, a single best alpha is chosen for each subject.
+    alphas, nboots, chunklen, nchunks, **kwargs
+        Passed on to bootstrap_ridge.
+
+    Returns
+    -------
+    wts, corrs, valphas, bootstrap_corrs : lists
+        The weights, test correlations, alphas and bootstrap correlations of each subject, as returned by
+        bootstrap_ridge.
+    valinds : array_like, shape (TH, B)
+        The held-out indices of each bootstrap sample, shared by every subject.
+    """
+    Rresp = ColumnStack(Rresps)
+    Presp = ColumnStack(Presps)
+    offsets = Rresp.offsets
+    subjvox = [slice(offsets[si], offsets[si+1]) for si in range(len(Rresps))]
+    
+    ## Choosing alphas for groups of voxels keeps each subject's choice separate
+    if single_alpha:
+        joined = [range(vox.start, vox.stop) for vox in subjvox]
+    elif joined is not None:
+        joined = [list(np.asarray(jl, dtype=int) + vox.start)
+                  for vox, subjjoined in zip(subjvox, joined) for jl in subjjoined]
+    
+    wt, corrs, valphas, allRcorrs, valinds = bootstrap_ridge(Rstim, Rresp, Pstim, Presp, alphas, nboots,
+                                                             chunklen, nchunks, joined=joined, **kwargs)
+    wts = [[] if isinstance(wt, list) else wt[:,vox] for vox in subjvox]
+    allRcorrs = [None if allRcorrs is None else allRcorrs[:,vox] for vox in subjvox]
+    return wts, [corrs[vox] for vox in subjvox], [valphas[vox] for vox in subjvox], allRcorrs, valinds
+
+
+def bootstrap_banded_ridge(Rstim, Rresp, Pstim, Presp, bands, alphas, nboots, chunklen, nchunks,
+                           nscalings=20, scalings=None, corrmin=0.2, singcutoff=1e-10, normalpha=False,
+                           use_corr=True, voxel_chunk=None, max_memory=None, seed=None, dtype=None,
+                           method="direct", logger=ridge_logger):
+    """Banded ridge regression: like bootstrap_ridge, but each feature space (band of columns of [Rstim])
+    gets its own regularization parameter for each response.
+
+    Banded ridge with a separate alpha for each band is the same as ordinary ridge with one alpha on a
+    stimulus whose bands are rescaled. So instead of a grid over every combination of band alphas, a
+    random search is done over [nscalings] band scalings, and the usual [alphas] are tested for each
+    one. The Gram matrix Rstim.T Rstim and the cross-products Rstim.T Rresp are computed once and reused
+    (downdated and rescaled) for every scaling and bootstrap sample, so each candidate scaling costs one
+    N x N eigendecomposition per bootstrap sample. Each response gets the scaling and alpha with the best
+    held-out correlation averaged across the bootstrap samples.
+
+    Parameters
+    ----------
+    Rstim, Rresp, Pstim, Presp : array_like
+        Training and test stimuli and responses, as in bootstrap_ridge. Rresp and Presp can be lazy arrays.
+    bands : list of slices or index arrays
+        The columns of Rstim that belong to each feature space (e.g. the delayed semantic, word rate and
+        phoneme features). Every column should be in exactly one band.
+    alphas : list or array_like, shape (A,)
+        Ridge parameters that will be tested for each scaling.
+    nboots, chunklen, nchunks : int
+        The number of bootstrap samples, and the length and number of held-out chunks, as in
+        bootstrap_ridge. The same held-out sets are used for every scaling.
+    nscalings : int, default 20
+        The number of band scalings to test. The first is the uniform scaling (ordinary ridge), the rest
+        are drawn from a flat Dirichlet distribution over the bands.
+    scalings : array_like, shape (C, B), or None
+        Band scalings to test instead of the random ones. Each row is scaled to sum to the number of
+        bands B, so that the uniform scaling is all ones.
+    corrmin, singcutoff, normalpha, use_corr, voxel_chunk, max_memory, dtype, method
+        As in bootstrap_ridge.
+    seed : int or None
+        Seed for the held-out sets and the random scalings. If None, the global random state is used.
+
+    Returns
+    -------
+    wt : array_like, shape (N, M)
+        Regression weights for the N features (in the original, unscaled feature space) and M responses.
+    corrs : array_like, shape (M,)
+        Test correlations between predicted and actual Presp.
+    band_alphas : array_like, shape (B, M)
+        The effective regularization parameter of each band for each response. A band that was scaled to
+        zero has an infinite alpha (it is not used by that response).
+    bestscaling : array_like, shape (M,)
+        The index of the scaling chosen for each response.
+    scalings : array_like, shape (C, B)
+        The band scalings that were tested.
+    bootstrap_corrs : array_like, shape (M,)
+        The mean held-out correlation of the chosen scaling and alpha for each response.
+    """
+    nresp, nvox = Rresp.shape
+    Rstim = _as_dtype(Rstim, dtype)
+    Pstim = _as_dtype(Pstim, dtype)
+    alphas = np.asarray(alphas)
+    
+    ## Find which band each feature is in
+    nbands = len(bands)
+    featband = np.zeros((Rstim.shape[1],), dtype=int)
+    nfeatbands = np.zeros((Rstim.shape[1],), dtype=int)
+    for bi, band in enumerate(bands):
+        featband[band] = bi
+        nfeatbands[band] += 1
+    if not (nfeatbands == 1).all():
+        raise ValueError("Every feature should be in exactly one band (%d are in none, %d in more than one)."
+                         %((nfeatbands == 0).sum(), (nfeatbands > 1).sum()))
+    
+    ## Choose the band scalings, which sum to the number of bands
+    if scalings is None:
+        randscalings = np.random.RandomState(seed).dirichlet(np.ones(nbands), max(nscalings - 1, 0))
+        scalings = np.vstack([np.ones((1, nbands)) / nbands, randscalings])
+    scalings = np.asarray(scalings, dtype=float)
+    scalings = nbands * scalings / scalings.sum(1)[:,None]
+    
+    # Select all of the held-out sets up front, so that every scaling is tested on the same ones
+    rng = random if seed is None else random.Random(seed)
+    splits = [_bootstrap_split(nresp, chunklen, nchunks, rng, logger) for bi in range(nboots)]
+    
+    logger.info("Precomputing Gram matrix and stimulus-response cross-products..")
+    gram = _gram_cross(Rstim, Rresp, voxel_chunk, max_memory, dtype)
+    
+    # Test every alpha for each scaling, keeping the best scaling and alpha for each response
+    bootargs = dict(alphas=alphas, corrmin=corrmin, singcutoff=singcutoff, normalpha=normalpha,
+                    use_corr=use_corr, voxel_chunk=voxel_chunk, max_memory=max_memory, solver="gram",
+                    svd_rank=None, svd_energy=None, dtype=dtype, method=method, logger=logger)
+    bestcorrs = np.full((nvox,), -np.inf)
+    bestscaling = np.zeros((nvox,), dtype=int)
+    valphas = np.zeros((nvox,))
+    for si in counter(range(len(scalings)), countevery=1, total=len(scalings)):
+        ## Scaling a band's features by sqrt(s) is the same as dividing its alpha by sqrt(s)
+        featscale = np.sqrt(scalings[si][featband])
+        meancorrs = np.zeros((len(alphas), nvox))
+        for heldinds, notheldinds in splits:
+            meancorrs += _bootstrap_corr(Rstim, Rresp, heldinds, notheldinds, gram=gram, scale=featscale,
+                                         **bootargs) / nboots
+        
+        scorrs = meancorrs.max(0)
+        better = scorrs > bestcorrs
+        bestcorrs[better] = scorrs[better]
+        bestscaling[better] = si
+        valphas[better] = alphas[np.argmax(meancorrs, 0)][better]
+        logger.info("Scaling %s is best for %d responses.."%(np.round(scalings[si], 3), better.sum()))
+    
+    # Find weights for each response using the entire training set and its best scaling
+    logger.info("Computing weights for each response using entire training set..")
+    G, C = gram
+    wt = np.zeros(C.shape, dtype=C.dtype)
+    blocks = voxel_blocks(nvox, 3 * C.shape[0], voxel_chunk=voxel_chunk, max_memory=max_memory,
+                          itemsize=C.dtype.itemsize)
+    for si in np.unique(bestscaling):
+        featscale = np.sqrt(scalings[si][featband])
+        V, S = _gram_eig(featscale[:,None] * G * featscale, singcutoff, logger)
+        for vox in blocks:
+            selvox = vox.start + np.nonzero(bestscaling[vox] == si)[0]
+            nalphas = valphas[selvox] * S[0] if normalpha else valphas[selvox]
+            ## With the scaled Gram matrix equal to V S**2 V.T, the weights are D V diag(1/(S**2+a**2)) V.T D C
+            VC = np.dot(V.T, featscale[:,None] * C[:,selvox]) / (S[:,None]**2 + nalphas**2)
+            wt[:,selvox] = featscale[:,None] * np.dot(V, VC)
+    
+    # Predict responses on prediction set and find prediction correlations, one voxel block at a time
+    logger.info("Predicting responses for predictions set..")
+    corrs = np.zeros((nvox,), dtype=wt.dtype)
+    blocks = voxel_blocks(nvox, 3 * Pstim.shape[0], voxel_chunk=voxel_chunk, max_memory=max_memory,
+                          itemsize=_itemsize(Presp, dtype))
+    getblock = lambda vox: read_columns(Presp, vox, dtype=dtype)
+    for vox, bPresp in zip(blocks, prefetch(getblock, blocks)):
+        pred = np.nan_to_num(Pstim.dot(wt[:,vox]))
+        if use_corr:
+            corrs[vox] = np.nan_to_num((zs(bPresp) * zs(pred)).mean(0))
+        else:
+            resvar = (bPresp-pred).var(0)
+            Rsqs = 1 - (resvar / bPresp.var(0))
+            corrs[vox] = np.sqrt(np.abs(Rsqs)) * np.sign(Rsqs)
+    
+    with np.errstate(divide="ignore"):
+        band_alphas = valphas / np.sqrt(scalings[bestscaling].T)
+    return wt, corrs, band_alphas, bestscaling, scalings, bestcorrs
+
+
+def prior_root(prior_cov, singcutoff=1e-10, logger=ridge_logger):
+    """Returns a square root A (N x r) of the prior covariance [prior_cov] (N x N), so that
+    A A.T == prior_cov. It is found from the eigendecomposition of prior_cov, and the eigenvectors
+    whose eigenvalues are less than [singcutoff] times the largest one are dropped, so a low-rank
+    prior gives a thin A. The root can be passed to tikhonov and bootstrap_tikhonov as [root] to avoid
+    recomputing it.
+    """
+    logger.info("Doing eigendecomposition of %s prior covariance.."%str(prior_cov.shape))
+    with stage("eigh", 9 * prior_cov.shape[0]**3):
+        L, Q = np.linalg.eigh(prior_cov)
+    good = L > singcutoff * L.max()
+    logger.info("Prior covariance has rank %d.."%good.sum())
+    return Q[:,good] * np.sqrt(L[good])
+
+
+def _unwhiten_weights(root, wt, voxel_chunk=None, max_memory=None):
+    """Maps weights [wt] (r x M) for the whitened stimulus stim A back to the original features, giving
+    A wt. [wt] can be a dense array, FactoredWeights or a RidgeModel (see bootstrap_ridge), or [].
+    """
+    if isinstance(wt, list):
+        return wt
+    if isinstance(wt, RidgeModel):
+        wt.wt = _unwhiten_weights(root, wt.wt, voxel_chunk, max_memory)
+        return wt
+    if isinstance(wt, FactoredWeights):
+        return FactoredWeights(np.dot(root, wt.left), wt.right)
+    
+    nvox = wt.shape[1]
+    out = np.zeros((root.shape[0], nvox), dtype=np.result_type(root.dtype, wt.dtype))
+    for vox in voxel_blocks(nvox, root.shape[0] + root.shape[1], voxel_chunk=voxel_chunk,
+                            max_memory=max_memory, itemsize=out.dtype.itemsize):
+        out[:,vox] = np.dot(root, wt[:,vox])
+    return out
+
+
+def tikhonov(stim, resp, prior_cov, alpha, root=None, singcutoff=1e-10, normalpha=False, solver="svd",
+             dtype=None, voxel_chunk=None, max_memory=None, factored=False, rank=None, logger=ridge_logger):
+    """Uses Tikhonov regression with a Gaussian prior on the weights whose covariance is [prior_cov] to
+    find a linear transformation of [stim] that approximates [resp]. The regularization parameter is
+    [alpha], and the weights minimize |resp - stim wt|^2 + alpha^2 wt.T prior_cov^-1 wt.
+
+    This is ridge regression on the whitened stimulus stim A, where A A.T == prior_cov (see prior_root),
+    with the weights mapped back by A. A is only found once, and the whitening is applied to the
+    stimulus before its factorization, so each alpha costs the same as in ridge(). If prior_cov has rank
+    r < N, the whitened stimulus has only r features.
+
+    Parameters
+    ----------
+    stim, resp, alpha, singcutoff, normalpha, solver, dtype, voxel_chunk, max_memory, factored, rank
+        As in ridge. [alpha] can be one value or one per response.
+    prior_cov : array_like, shape (N, N), or None
+        Prior covariance of the weights, e.g. a feature covariance from a SemanticModel. Can be None if
+        [root] is given.
+    root : array_like, shape (N, r), or None
+        The square root of prior_cov from prior_root, if it has already been found.
+
+    Returns
+    -------
+    wt : array_like, shape (N, M), or FactoredWeights
+        Tikhonov regression weights.
+    """
+    if root is None:
+        root = prior_root(prior_cov, singcutoff, logger)
+    stim = _as_dtype(stim, dtype)
+    wstim = stim.dot(_as_dtype(root, dtype))
+    wt = ridge(wstim, resp, alpha, singcutoff=singcutoff, normalpha=normalpha, solver=solver, dtype=dtype,
+               voxel_chunk=voxel_chunk, max_memory=max_memory, factored=True, rank=rank, logger=logger)
+    wt = _unwhiten_weights(_as_dtype(root, dtype), wt)
+    return wt if factored else wt.dense(voxel_chunk=voxel_chunk, max_memory=max_memory)
+
+
+def bootstrap_tikhonov(Rstim, Rresp, Pstim, Presp, prior_cov, alphas, nboots, chunklen, nchunks, root=None,
+                       singcutoff=1e-10, logger=ridge_logger, **kwargs):
+    """Uses Tikhonov regression with the prior covariance [prior_cov] (N x N) and a bootstrapped held-out
+    set to get optimal alpha values for each response (see tikhonov and bootstrap_ridge).
+
+    The prior's square root A (see prior_root) is found once, or given as [root], and Rstim and Pstim are
+    whitened by it once. bootstrap_ridge is then run on the whitened stimuli, so every option and speedup
+    of bootstrap_ridge (per-response alphas, voxel blocks, the Gram and spectral solvers, parallel
+    bootstrap samples) is available through [kwargs]. The returned weights are mapped back to the original
+    features by A. Returns the same values as bootstrap_ridge.
+    """
+    if root is None:
+        root = prior_root(prior_cov, singcutoff, logger)
+    dtype = kwargs.get("dtype")
+    root = _as_dtype(root, dtype)
+    wRstim = _as_dtype(Rstim, dtype).dot(root)
+    wPstim = _as_dtype(Pstim, dtype).dot(root)
+    wt, corrs, valphas, allRcorrs, valinds = bootstrap_ridge(wRstim, Rresp, wPstim, Presp, alphas, nboots,
+                                                             chunklen, nchunks, singcutoff=singcutoff,
+                                                             logger=logger, **kwargs)
+    wt = _unwhiten_weights(root, wt, kwargs.get("voxel_chunk"), kwargs.get("max_memory"))
+    return wt, corrs, valphas, allRcorrs, valinds
+
 
-        return [], corrs, valphas, allRcorrs, valinds
\ No newline at end of file
+def ridge_cv_runs(stim, resp, runlens, alphas, joined=None, single_alpha=False, singcutoff=1e-10,
+                  normalpha=False, use_corr=True, voxel_chunk=None, max_memory=None, dtype=None,
+                  logger=ridge_logger):
+    """Nested leave-one-run-out cross-validation of ridge regression. The time points of [stim] and
+    [resp] are split into contiguous runs (e.g. stories) of lengths [runlens]. Each run is held out in
+    turn, the alphas are chosen by leave-one-run-out cross-validation on the remaining runs, and the
+    held-out run is predicted from a model fit to all of the remaining runs with those alphas.
+
+    The Gram block stim_r.T stim_r of each run r and the cross-products stim.T resp are computed once.
+    The Gram matrix of each fold's training runs is assembled from the run blocks and factorized once
+    per fold. The inner held-out predictions are found in closed form from that factorization: the
+    held-out residuals of an inner run are (I - H_rr)^-1 times its in-sample residuals, where H_rr is
+    the run's diagonal block of the hat matrix (see the "loco" selection in bootstrap_ridge). This is
+    the same as refitting without the inner run, up to the tiny singular values dropped by [singcutoff].
+
+    Parameters
+    ----------
+    stim : array_like, shape (T, N)
+        Stimuli with T time points and N features, with the runs stacked in order.
+    resp : array_like, shape (T, M)
+        Responses with T time points and M responses. This can be a lazy array (see
+        ridge_utils.read_columns), which is read one block of responses at a time.
+    runlens : list of int
+        The number of time points in each run. These should sum to T, and there should be at least
+        three runs so that the alphas can be cross-validated within each fold.
+    alphas : list or array_like, shape (A,)
+        Ridge parameters that will be tested for each response.
+    joined : None or list of lists
+        Groups of responses that should share one alpha in each fold, as in bootstrap_ridge.
+    single_alpha : boolean, default False
+        If True, a single alpha is chosen for all responses in each fold.
+    singcutoff, normalpha, use_corr, voxel_chunk, max_memory, dtype
+        As in bootstrap_ridge. [use_corr] sets how the alphas are scored and how the final held-out
+        predictions are compared to the responses.
+
+    Returns
+    -------
+    pred : array_like, shape (T, M)
+        The held-out prediction of each run, concatenated across folds.
+    corrs : array_like, shape (M,)
+        Correlation (or signed sqrt of R^2) between [pred] and the responses.
+    valphas : array_like, shape (R, M)
+        The alpha chosen for each response in each of the R folds.
+    innercorrs : array_like, shape (R, A, M)
+        The inner leave-one-run-out score of each alpha for each response in each fold.
+    """
+    stim = _as_dtype(stim, dtype)
+    alphas = np.asarray(alphas)
+    ntime, nvox = resp.shape
+    runlens = [int(rl) for rl in runlens]
+    if sum(runlens) != ntime:
+        raise ValueError("Runs cover %d time points, but there are %d."%(sum(runlens), ntime))
+    if len(runlens) < 3:
+        raise ValueError("Nested leave-one-run-out cross-validation needs at least three runs.")
+    bounds = np.cumsum([0] + runlens)
+    runs = [slice(bounds[ri], bounds[ri+1]) for ri in range(len(runlens))]
+    
+    ## Gram block of each run, and cross-products for all of the runs
+    with stage("gram", 2 * ntime * stim.shape[1]**2):
+        rungrams = [_gram(stim[run]) for run in runs]
+    G = sum(rungrams)
+    C = _gram_cross(stim, resp, voxel_chunk, max_memory, dtype)[1]
+    
+    pred = np.zeros((ntime, nvox), dtype=C.dtype)
+    valphas = np.zeros((len(runs), nvox))
+    innercorrs = np.zeros((len(runs), len(alphas), nvox), dtype=C.dtype)
+    for oi, orun in enumerate(runs):
+        logger.info("Holding out run %d of %d.."%(oi+1, len(runs)))
+        inner = [run for run in runs if run is not orun]
+        innerrows = np.concatenate([np.arange(run.start, run.stop) for run in inner])
+        V, S = _gram_eig(G - rungrams[oi], singcutoff, logger)
+        nalphas = np.asarray(alphas * S[0] if normalpha else alphas, dtype=S.dtype)
+        shrink = 1 / (S[:,None]**2 + nalphas**2)
+        with stage("PVh", 2 * ntime * stim.shape[1] * S.shape[0]):
+            SV = stim.dot(V)
+        ostim = stim[orun]
+        
+        ## The hat matrix of the training runs is (stim V) diag(shrink) (stim V).T
+        with stage("hat", sum(2 * (run.stop - run.start)**2 * (S.shape[0] + run.stop - run.start)
+                              for run in inner) * len(nalphas)):
+            Hinvs = [[np.linalg.inv(np.eye(run.stop - run.start, dtype=S.dtype)
+                                    - np.dot(SV[run] * shrink[:,ai], SV[run].T))
+                      for ai in range(len(nalphas))] for run in inner]
+        
+        blocks = voxel_blocks(nvox, 4 * ntime + 2 * S.shape[0], voxel_chunk=voxel_chunk,
+                              max_memory=max_memory, itemsize=_itemsize(resp, dtype))
+        getblock = lambda vox: np.nan_to_num(read_columns(resp, vox, dtype=dtype))
+        for vox, bresp in zip(blocks, prefetch(getblock, blocks)):
+            with stage("scoring"):
+                VC = np.dot(V.T, C[:,vox] - np.dot(ostim.T, bresp[orun]))
+                innerresp = bresp[innerrows]
+                for ai in range(len(nalphas)):
+                    fitted = np.dot(SV, shrink[:,ai,None] * VC)
+                    innerpred = np.vstack([bresp[run] - np.dot(Hinv[ai], bresp[run] - fitted[run])
+                                           for run, Hinv in zip(inner, Hinvs)])
+                    if use_corr:
+                        innercorrs[oi,ai,vox] = np.nan_to_num((zs(innerresp) * zs(innerpred)).mean(0))
+                    else:
+                        Rsq = 1 - (innerresp - innerpred).var(0) / innerresp.var(0)
+                        innercorrs[oi,ai,vox] = np.sqrt(np.abs(Rsq)) * np.sign(Rsq)
+        
+        ## Choose the alphas for this fold
+        meancorrs = innercorrs[oi]
+        if single_alpha:
+            joined = [range(nvox)]
+        if joined is None:
+            valphas[oi] = alphas[np.argmax(meancorrs, 0)]
+        else:
+            for jl in joined:
+                valphas[oi,jl] = alphas[np.argmax(meancorrs[:,jl].mean(1))]
+        
+        ## Predict the held-out run from all of the training runs
+        ualphas, alphainds = np.unique(valphas[oi] * S[0] if normalpha else valphas[oi], return_inverse=True)
+        oshrink = 1 / (S[:,None]**2 + np.asarray(ualphas, dtype=S.dtype)**2)
+        blocks = voxel_blocks(nvox, 2 * (orun.stop - orun.start) + 2 * S.shape[0],
+                              voxel_chunk=voxel_chunk, max_memory=max_memory, itemsize=_itemsize(resp, dtype))
+        getblock = lambda vox: np.nan_to_num(read_columns(resp, vox, np.arange(orun.start, orun.stop),
+                                                          dtype=dtype))
+        for vox, oresp in zip(blocks, prefetch(getblock, blocks)):
+            with stage("prediction"):
+                VC = np.dot(V.T, C[:,vox] - np.dot(ostim.T, oresp))
+                pred[orun,vox] = np.dot(SV[orun], oshrink[:,alphainds[vox]] * VC)
+    
+    ## Score the concatenated held-out predictions
+    corrs = np.zeros((nvox,), dtype=pred.dtype)
+    blocks = voxel_blocks(nvox, 2 * ntime, voxel_chunk=voxel_chunk, max_memory=max_memory,
+                          itemsize=_itemsize(resp, dtype))
+    getblock = lambda vox: np.nan_to_num(read_columns(resp, vox, dtype=dtype))
+    for vox, bresp in zip(blocks, prefetch(getblock, blocks)):
+        if use_corr:
+            corrs[vox] = np.nan_to_num((zs(bresp) * zs(pred[:,vox])).mean(0))
+        else:
+            Rsq = 1 - (bresp - pred[:,vox]).var(0) / bresp.var(0)
+            corrs[vox] = np.sqrt(np.abs(Rsq)) * np.sign(Rsq)
+    logger.info("Mean held-out correlation across runs: %0.5f"%corrs.mean())
+    
+    return pred, corrs, valphas, innercorrs
+
+
+def _gram_cross(Rstim, Rresp, voxel_chunk, max_memory, dtype):
+    """Returns the Gram matrix Rstim.T Rstim and the cross-products Rstim.T Rresp, which are found one
+    block of responses at a time.
+    """
+    nresp, nvox = Rresp.shape
+    crossdtype = np.result_type(Rstim.dtype, Rresp.dtype) if dtype is None else dtype
+    cross = np.empty((Rstim.shape[1], nvox), dtype=crossdtype)
+    with stage("gram", 2 * nresp * Rstim.shape[1] * (Rstim.shape[1] + nvox)):
+        for vox in voxel_blocks(nvox, nresp, voxel_chunk=voxel_chunk, max_memory=max_memory,
+                                itemsize=_itemsize(Rresp, dtype)):
+            cross[:,vox] = Rstim.T.dot(read_columns(Rresp, vox, dtype=dtype))
+        return _gram(Rstim), cross
+
+
+def _bootstrap_split(nresp, chunklen, nchunks, rng, logger=ridge_logger):
+    """Randomly selects [nchunks] chunks of length [chunklen] from [nresp] time points to hold out,
+    using the random number generator [rng]. Returns the held-out and not-held-out indices.
+    """
+    logger.info("Selecting held-out test set..")
+    allinds = range(nresp)
+    indchunks = list(zip(*[iter(allinds)]*chunklen))
+    rng.shuffle(indchunks)
+    heldinds = list(itools.chain(*indchunks[:nchunks]))
+    notheldinds = list(set(allinds)-set(heldinds))
+    return heldinds, notheldinds
+
+
+def _bootstrap_corr(Rstim, Rresp, heldinds, notheldinds, alphas, corrmin, singcutoff, normalpha,
+                    use_corr, voxel_chunk, max_memory, solver, svd_rank, svd_energy, dtype, method, logger,
+                    gram=None, scale=None):
+    """Runs ridge_corr for a single bootstrap sample, holding out the time points [heldinds].
+    If [gram] is given it should be the precomputed (Rstim.T Rstim, Rstim.T Rresp) pair, which is
+    downdated by the held-out time points instead of factorizing the held-in stimulus with [solver].
+    If [scale] (N,) is also given, the features of Rstim are multiplied by it (see bootstrap_banded_ridge)
+    without copying the Gram matrix or cross-products.
+    Returns the (A, M) array of held-out correlations.
+    """
+    nresp, nvox = Rresp.shape
+    PRstim = Rstim[heldinds,:]
+    
+    # Run ridge regression using this test set. The stimulus factorization is shared by all voxel
+    # blocks, and the held-in/held-out responses are only copied one block at a time.
+    if gram is None:
+        U, S, PVh = _factor_stim(Rstim[notheldinds,:], PRstim, singcutoff, solver, logger,
+                                 svd_rank, svd_energy)
+        blocks = voxel_blocks(nvox, nresp + S.shape[0] + 4 * len(heldinds),
+                              voxel_chunk=voxel_chunk, max_memory=max_memory,
+                              itemsize=_itemsize(Rresp, dtype))
+        def getblock(vox):
+            Rblock = read_columns(Rresp, vox, dtype=dtype)
+            return np.dot(U.T, Rblock[notheldinds]), Rblock[heldinds]
+        getblock = staged("UR", getblock, 2 * len(notheldinds) * S.shape[0])
+    else:
+        ## Remove the held-out time points from the Gram matrix and cross-products
+        G, C = gram
+        with stage("downdate", 2 * PRstim.shape[0] * PRstim.shape[1]**2):
+            Gheld = G - np.dot(PRstim.T, PRstim)
+        if scale is not None:
+            Gheld = scale[:,None] * Gheld * scale
+            PRstim = PRstim * scale
+        V, S = _gram_eig(Gheld, singcutoff, logger)
+        with stage("PVh", 2 * PRstim.shape[0] * PRstim.shape[1] * S.shape[0]):
+            PVh = np.dot(PRstim, V)
+        blocks = voxel_blocks(nvox, 2 * C.shape[0] + S.shape[0] + 5 * len(heldinds),
+                              voxel_chunk=voxel_chunk, max_memory=max_memory,
+                              itemsize=_itemsize(Rresp, dtype))
+        def getblock(vox):
+            PRresp = read_columns(Rresp, vox, heldinds, dtype=dtype)
+            ## U.T R == S^-1 V.T (Rstim.T R) for the held-in part of Rstim and R
+            Cblock = C[:,vox] if scale is None else scale[:,None] * C[:,vox]
+            UR = np.dot(V.T, Cblock - np.dot(PRstim.T, PRresp)) / S[:,None]
+            return UR, PRresp
+        getblock = staged("UR", getblock, 2 * C.shape[0] * (len(heldinds) + S.shape[0]))
+    
+    return _ridge_corr_blocks(S, PVh, getblock, blocks, nvox, alphas,
+                              normalpha, corrmin, use_corr, logger, method=method)
+
+
+def _closed_form_scores(Rstim, Rresp, alphas, selection, chunklen, singcutoff, normalpha, use_corr, solver,
+                        voxel_chunk, max_memory, dtype, logger):
+    """Scores every alpha in [alphas] for each response with generalized cross-validation ([selection] "gcv")
+    or leave-one-chunk-out cross-validation ("loco", with chunks of length [chunklen]), computed in closed
+    form from one factorization of [Rstim] (see bootstrap_ridge). Returns the (A, M) array of scores.
+    """
+    nresp, nvox = Rresp.shape
+    if _resolve_solver(solver, Rstim.shape, dtype=Rstim.dtype) == "dual":
+        U, S = _gram_eig(_kernel(Rstim), singcutoff, logger)
+    elif isinstance(Rstim, DelayedMatrix):
+        V, S = _gram_eig(_gram(Rstim), singcutoff, logger)
+        U = Rstim.dot(V) / S
+    else:
+        U, S, Vh = _stim_svd(Rstim, singcutoff, logger)
+    
+    if normalpha:
+        nalphas = alphas * S[0]
+    else:
+        nalphas = alphas
+    nalphas = np.asarray(nalphas, dtype=S.dtype)
+    ## The hat matrix of each alpha is U diag(shrink) U.T, so its trace is the sum of shrink
+    shrink = S[:,None]**2 / (S[:,None]**2 + nalphas**2)
+    
+    if selection == "loco":
+        ## The held-out residuals of a chunk are (I - H_cc)^-1 times its in-sample residuals, where H_cc
+        ## is the chunk's diagonal block of the hat matrix. The full chunks are handled in one batch, and
+        ## the shorter chunk at the end (if any) in a second one.
+        nfull = nresp // chunklen * chunklen
+        batches = [(slice(0, nfull), chunklen)]
+        if nfull < nresp:
+            batches.append((slice(nfull, nresp), nresp - nfull))
+        Hinvs = []
+        for rows, length in batches:
+            Uc = U[rows].reshape(-1, length, U.shape[1])
+            eye = np.eye(length, dtype=S.dtype)
+            Hinvs.append([np.linalg.inv(eye - np.matmul(Uc * shrink[:,ai], Uc.transpose(0, 2, 1)))
+                          for ai in range(len(nalphas))])
+    elif selection != "gcv":
+        raise ValueError("Unknown selection %r, should be 'gcv' or 'loco'." % (selection,))
+    
+    scores = np.zeros((len(nalphas), nvox), dtype=S.dtype)
+    blocks = voxel_blocks(nvox, 4 * nresp + S.shape[0], voxel_chunk=voxel_chunk, max_memory=max_memory,
+                          itemsize=_itemsize(Rresp, dtype))
+    getblock = lambda vox: np.nan_to_num(read_columns(Rresp, vox, dtype=dtype))
+    for vox, resp in zip(blocks, prefetch(getblock, blocks)):
+        UR = np.dot(U.T, resp)
+        respvar = resp.var(0)
+        for ai in range(len(nalphas)):
+            fitted = np.dot(U, shrink[:,ai,None] * UR)
+            if selection == "gcv":
+                rss = ((resp - fitted)**2).mean(0)
+                resvar = rss / (1 - shrink[:,ai].sum() / nresp)**2
+                Rsq = 1 - resvar / respvar
+                scores[ai,vox] = np.sqrt(np.abs(Rsq)) * np.sign(Rsq)
+                continue
+            
+            resid = resp - fitted
+            for (rows, length), Hinv in zip(batches, Hinvs):
+                rchunks = resid[rows].reshape(-1, length, resid.shape[1])
+                resid[rows] = np.matmul(Hinv[ai], rchunks).reshape(-1, resid.shape[1])
+            if use_corr:
+                scores[ai,vox] = np.nan_to_num((zs(resp) * zs(resp - resid)).mean(0))
+            else:
+                Rsq = 1 - resid.var(0) / respvar
+                scores[ai,vox] = np.sqrt(np.abs(Rsq)) * np.sign(Rsq)
+    
+    return scores
+
+
+def _resolve_solver(solver, shape, allowed=("svd", "dual"), dtype=np.float64):
+    """Returns the solver that should be used for a stimulus with the given [shape] and [dtype], checking
+    that it is "auto" or one of the [allowed] solvers. "auto" only picks "dual", which squares the
+    conditioning, for wide float64 stimuli.
+    """
+    if solver == "auto":
+        return "dual" if shape[1] > shape[0] and np.dtype(dtype) == np.float64 else "svd"
+    elif solver in allowed:
+        return solver
+    raise ValueError("Unknown solver %r, should be one of %s." % (solver, ", ".join(("auto",)+allowed)))
+
+
+def _factor_stim(Rstim, Pstim, singcutoff, solver, logger, svd_rank=None, svd_energy=None):
+    """Factorizes the training stimulus [Rstim] with the given [solver] (see ridge_corr). Returns the
+    left singular vectors U, singular values S, and the product of [Pstim] with Vh.T.
+    [Rstim] and [Pstim] can be DelayedMatrix operators, which are never formed. The "svd" solver then
+    finds V and S from the Gram matrix of Rstim, and U from Rstim V diag(1/S).
+    """
+    solver = _resolve_solver(solver, Rstim.shape, ("svd", "dual", "randomized"), Rstim.dtype)
+    ntest, nfeat = Pstim.shape
+    if solver == "dual":
+        ## Vh.T == Rstim.T U diag(1/S), so Pstim Vh.T can be found from the test-train kernel
+        U, S = _gram_eig(_kernel(Rstim), singcutoff, logger)
+        if isinstance(Rstim, DelayedMatrix) or isinstance(Pstim, DelayedMatrix):
+            with stage("PVh", 2 * nfeat * S.shape[0] * (Rstim.shape[0] + ntest)):
+                PVh = Pstim.dot(Rstim.T.dot(U)) / S
+        else:
+            with stage("PVh", 2 * ntest * Rstim.shape[0] * (nfeat + S.shape[0])):
+                PVh = np.dot(np.dot(Pstim, Rstim.T), U) / S
+        return U, S, PVh
+    
+    if solver == "randomized":
+        U, S, Vh = _stim_randomized_svd(Rstim, singcutoff, svd_rank, svd_energy, logger)
+    elif isinstance(Rstim, DelayedMatrix):
+        V, S = _gram_eig(_gram(Rstim), singcutoff, logger)
+        with stage("U", 2 * Rstim.shape[0] * nfeat * S.shape[0]):
+            U, Vh = Rstim.dot(V) / S, V.T
+    else:
+        U, S, Vh = _stim_svd(Rstim, singcutoff, logger)
+    with stage("PVh", 2 * ntest * nfeat * S.shape[0]):
+        PVh = Pstim.dot(Vh.T)
+    return U, S, PVh
+
+
+def _stim_randomized_svd(stim, singcutoff, rank, energy, logger):
+    """Computes a randomized truncated SVD of [stim] that keeps [rank] singular values, or enough of them
+    to keep the fraction [energy] of the sum of squared singular values. Singular values less than
+    [singcutoff] are then dropped, as in _stim_svd.
+    """
+    if rank is None and energy is None:
+        raise ValueError("The randomized solver needs svd_rank or svd_energy.")
+    
+    maxrank = min(stim.shape)
+    totalenergy = stim.sqnorm() if isinstance(stim, DelayedMatrix) else np.vdot(stim, stim)
+    rank = min(maxrank, 64 if rank is None else rank)
+    while True:
+        logger.info("Doing randomized SVD with rank %d..."%rank)
+        with stage("randomized_svd", 12 * stim.shape[0] * stim.shape[1] * (rank + 10)):
+            U, S, Vh = randomized_svd(stim, rank)
+        if energy is None or rank == maxrank or (S**2).sum() >= energy * totalenergy:
+            break
+        rank = min(2 * rank, maxrank) ## Not enough energy captured, try again with twice the rank
+    
+    if energy is not None:
+        ## Keep the fewest singular values that reach the energy target
+        rank = min(np.searchsorted(np.cumsum(S**2), energy * totalenergy) + 1, S.shape[0])
+    ngoodS = min(rank, np.sum(S > singcutoff))
+    U, S, Vh = U[:,:ngoodS], S[:ngoodS], Vh[:ngoodS]
+    logger.info("Kept %d singular values, discarding %0.4f%% of the stimulus energy.. (U is now %s)"
+                %(ngoodS, 100 * (1 - (S**2).sum() / totalenergy), str(U.shape)))
+    return U, S, Vh
+
+
+def _gram_eig(G, singcutoff, logger):
+    """Finds the right singular vectors V and singular values S of a stimulus matrix from the
+    eigendecomposition of its Gram matrix [G] (stim.T times stim). Singular values less than
+    [singcutoff] are dropped, as in _stim_svd. Returns V (N x k) and S (k,) in decreasing order.
+    Given the kernel matrix (stim times stim.T) instead, the left singular vectors U are returned.
+    """
+    logger.info("Doing eigendecomposition of %s Gram matrix..."%str(G.shape))
+    with stage("eigh", 9 * G.shape[0]**3):
+        L, V = np.linalg.eigh(G)
+    S = np.sqrt(np.clip(L[::-1], 0, None))
+    V = V[:,::-1]
+    
+    ## Truncate tiny singular values for speed
+    ngoodS = np.sum(S > singcutoff)
+    logger.info("Dropped %d tiny singular values.. (eigenvectors are now %s)"%(S.shape[0]-ngoodS, str(V[:,:ngoodS].shape)))
+    return V[:,:ngoodS], S[:ngoodS]
+
+
+## Environment variables that control the number of threads used by the common BLAS libraries
+_blas_thread_vars = ("OMP_NUM_THREADS", "OPENBLAS_NUM_THREADS", "MKL_NUM_THREADS",
+                     "VECLIB_MAXIMUM_THREADS", "NUMEXPR_NUM_THREADS")
+
+@contextlib.contextmanager
+def _blas_thread_limit(nthreads):
+    """Sets the BLAS thread count variables to [nthreads] while processes are started in this context,
+    so that those processes load their BLAS libraries with that many threads.
+    """
+    oldenv = dict((var, os.environ.get(var)) for var in _blas_thread_vars)
+    os.environ.update((var, str(nthreads)) for var in _blas_thread_vars)
+    try:
+        yield
+    finally:
+        for var, val in oldenv.items():
+            if val is None:
+                del os.environ[var]
+            else:
+                os.environ[var] = val
+
+
+def _memmap_array(arr, filename, blocks=None):
+    """Returns a description of a memory-mapped copy of [arr] that worker processes can open with
+    _open_memmap. Arrays that already are memory-mapped files are used in place, others are written
+    to [filename]. Lazy arrays (see ridge_utils.read_columns) are copied one column block in [blocks]
+    at a time.
+    """
+    if isinstance(arr, np.memmap) and isinstance(arr.base, mmap.mmap) and arr.flags.c_contiguous:
+        return (arr.filename, arr.dtype.str, arr.shape, arr.offset)
+    
+    mm = np.lib.format.open_memmap(filename, mode="w+", dtype=arr.dtype, shape=arr.shape)
+    if isinstance(arr, np.ndarray) or blocks is None:
+        mm[:] = arr
+    else:
+        for cols in blocks:
+            mm[:,cols] = read_columns(arr, cols)
+    mm.flush()
+    return (filename, arr.dtype.str, arr.shape, mm.offset)
+
+
+def _open_memmap(desc, mode="r"):
+    """Opens the memory-mapped array described by [desc] (see _memmap_array).
+    """
+    filename, dtype, shape, offset = desc
+    return np.memmap(filename, dtype=dtype, mode=mode, shape=shape, offset=offset)
+
+
+_worker_arrays = dict() ## Arrays shared with this process when it is a bootstrap worker
+
+def _bootstrap_worker_init(stimdesc, respdesc, outdesc, gramdescs, blas_threads):
+    """Opens the shared arrays in a bootstrap worker process and caps its BLAS thread pools at
+    [blas_threads]. The cap is set through the environment before the worker is spawned (see
+    _blas_thread_limit), and is applied again with threadpoolctl where that is installed.
+    """
+    try:
+        from threadpoolctl import threadpool_limits
+    except ImportError:
+        pass
+    else:
+        _worker_arrays["threadpool_limits"] = threadpool_limits(limits=blas_threads)
+    stimdesc, delays = stimdesc
+    _worker_arrays["Rstim"] = _open_memmap(stimdesc)
+    if delays is not None:
+        _worker_arrays["Rstim"] = DelayedMatrix(_worker_arrays["Rstim"], delays)
+    _worker_arrays["Rresp"] = _open_memmap(respdesc)
+    _worker_arrays["Rcorrs"] = _open_memmap(outdesc, mode="r+")
+    if gramdescs is None:
+        _worker_arrays["gram"] = None
+    else:
+        _worker_arrays["gram"] = tuple(_open_memmap(desc) for desc in gramdescs)
+
+
+def _bootstrap_worker(task):
+    """Runs one bootstrap sample in a worker process and stores its correlations in the shared output.
+    """
+    bi, heldinds, notheldinds, bootargs = task
+    Rcorrs = _worker_arrays["Rcorrs"]
+    Rcorrs[bi] = _bootstrap_corr(_worker_arrays["Rstim"], _worker_arrays["Rresp"],
+                                 heldinds, notheldinds, gram=_worker_arrays["gram"], **bootargs)
+    Rcorrs.flush()
+    return bi, _worker_blas_threads()
+
+
+def _worker_blas_threads():
+    """Returns the largest number of threads that the BLAS and OpenMP libraries loaded in this process
+    will use, as reported by threadpoolctl. Where threadpoolctl is not installed, this falls back to the
+    OMP_NUM_THREADS variable the process was spawned with, which only shows the cap was requested, not
+    that the libraries picked it up. Returns None if neither is available.
+    """
+    try:
+        from threadpoolctl import threadpool_info
+    except ImportError:
+        nthreads = os.environ.get("OMP_NUM_THREADS")
+        return None if nthreads is None else int(nthreads)
+    pools = threadpool_info()
+    return max(pool["num_threads"] for pool in pools) if pools else None
+
+
+def _main_importable():
+    """Returns False if spawned worker processes would fail to re-import the __main__ module, i.e. when
+    it names a file that does not exist (code piped through stdin, or some notebook and embedded
+    interpreters). Interactive sessions and python -c have no __main__ file and need no re-import.
+    """
+    main = sys.modules.get("__main__")
+    mainfile = getattr(main, "__file__", None)
+    if getattr(main, "__spec__", None) is not None or mainfile is None:
+        return True
+    return os.path.exists(mainfile)
+
+
+def _parallel_bootstraps(Rstim, Rresp, gram, splits, todo, n_jobs, blas_threads, tmpdir, bootargs,
+                         out=None, done=None, logger=ridge_logger):
+    """Runs the bootstrap samples given by [splits] whose indices are in [todo] in a pool of [n_jobs]
+    worker processes. [gram] is None or the precomputed Gram matrix and cross-products (see _bootstrap_corr).
+    The correlations are written into the (B, A, M) memory-mapped array [out] and each finished sample is
+    marked in [done] (see _open_checkpoint), or into a temporary array if [out] is None.
+    Returns the (B, A, M) array of held-out correlations, or None if the worker processes could not be
+    started, in which case the caller should run the samples that are not marked in [done] serially.
+    """
+    if not _main_importable():
+        logger.warning("The __main__ module (%s) cannot be re-imported by spawned worker processes; "
+                       "running the bootstrap samples serially.", getattr(sys.modules["__main__"], "__file__", None))
+        return None
+    
+    nboots = len(splits)
+    nalphas = len(bootargs["alphas"])
+    nvox = Rresp.shape[1]
+    if blas_threads is None:
+        blas_threads = max(1, os.cpu_count() // n_jobs)
+    
+    workdir = tempfile.mkdtemp(prefix="bootstrap_ridge_", dir=tmpdir)
+    try:
+        if isinstance(Rstim, DelayedMatrix):
+            ## Only the undelayed stimulus is shared, and the workers wrap it in a DelayedMatrix again
+            stimdesc = (_memmap_array(Rstim.stim, os.path.join(workdir, "Rstim.npy")), Rstim.delays)
+        else:
+            stimdesc = (_memmap_array(Rstim, os.path.join(workdir, "Rstim.npy")), None)
+        respblocks = voxel_blocks(nvox, Rresp.shape[0], voxel_chunk=bootargs["voxel_chunk"],
+                                  max_memory=bootargs["max_memory"], itemsize=_itemsize(Rresp, None))
+        respdesc = _memmap_array(Rresp, os.path.join(workdir, "Rresp.npy"), respblocks)
+        if gram is None:
+            gramdescs = None
+        else:
+            gramdescs = (_memmap_array(gram[0], os.path.join(workdir, "gram.npy")),
+                         _memmap_array(gram[1], os.path.join(workdir, "cross.npy")))
+        if out is None:
+            Rcorrs = np.lib.format.open_memmap(os.path.join(workdir, "Rcorrs.npy"), mode="w+",
+                                               dtype=np.float64 if bootargs["dtype"] is None else bootargs["dtype"],
+                                               shape=(nboots, nalphas, nvox))
+        else:
+            Rcorrs = out
+        outdesc = (Rcorrs.filename, Rcorrs.dtype.str, Rcorrs.shape, Rcorrs.offset)
+        
+        ## Workers are spawned (not forked) so that they load BLAS with the capped thread count. The
+        ## executor only starts its processes as tasks are submitted, so every task is submitted while
+        ## the thread limit is still set in the environment
+        ctx = multiprocessing.get_context("spawn")
+        pool = concurrent.futures.ProcessPoolExecutor(min(n_jobs, len(todo)), mp_context=ctx,
+                                                      initializer=_bootstrap_worker_init,
+                                                      initargs=(stimdesc, respdesc, outdesc, gramdescs,
+                                                                blas_threads))
+        try:
+            with _blas_thread_limit(blas_threads):
+                futures = [pool.submit(_bootstrap_worker, (bi, splits[bi][0], splits[bi][1], bootargs))
+                           for bi in todo]
+            warned = False
+            for future in counter(concurrent.futures.as_completed(futures), countevery=1, total=len(futures)):
+                bi, workerthreads = future.result()
+                if workerthreads != blas_threads and not warned:
+                    logger.warning("A bootstrap worker was started with %s BLAS threads instead of %d.",
+                                   workerthreads, blas_threads)
+                    warned = True
+                if done is not None:
+                    _mark_done(Rcorrs, done, bi)
+        except concurrent.futures.process.BrokenProcessPool:
+            ## A worker died while re-importing __main__, which usually means the calling script runs
+            ## bootstrap_ridge at module level instead of under an if __name__ == "__main__" guard
+            logger.warning("Bootstrap worker processes died on startup; running the bootstrap samples serially. "
+                           "Scripts that call bootstrap_ridge with n_jobs > 1 must guard their top-level "
+                           "code with if __name__ == \"__main__\".")
+            return None
+        finally:
+            pool.shutdown(wait=True, cancel_futures=True)
+        
+        return np.array(Rcorrs) if out is None else out
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def _open_checkpoint(checkpoint_dir, splits, alphas, nvox, dtype, settings, logger):
+    """Opens the bootstrap checkpoint in [checkpoint_dir], or creates one for the held-out sets in [splits]
+    if there is none. [settings] is a dict of the other bootstrap_ridge arguments that the stored
+    correlations depend on (stored in settings.json), and a checkpoint whose settings differ is rejected.
+    Returns the (B, A, M) memory-mapped bootstrap correlations, the (B,) memory-mapped flags that mark the
+    finished bootstrap samples, and the held-out sets of the checkpoint (which replace [splits] when an
+    interrupted run is resumed).
+    """
+    paths = dict((name, os.path.join(checkpoint_dir, name + ".npy"))
+                 for name in ("alphas", "valinds", "bootstrap_corrs", "bootstrap_done"))
+    settingspath = os.path.join(checkpoint_dir, "settings.json")
+    shape = (len(splits), len(alphas), nvox)
+    nresp = len(splits[0][0]) + len(splits[0][1])
+    if os.path.exists(paths["bootstrap_done"]):
+        Rcorrs = np.load(paths["bootstrap_corrs"], mmap_mode="r+")
+        done = np.load(paths["bootstrap_done"], mmap_mode="r+")
+        if Rcorrs.shape != shape or not np.array_equal(np.load(paths["alphas"]), alphas):
+            raise ValueError("The checkpoint in %s is from a different run (its bootstrap correlations have "
+                             "shape %s, expected %s)."%(checkpoint_dir, Rcorrs.shape, shape))
+        with open(settingspath) as f:
+            stored = json.load(f)
+        changed = ["%s=%r (checkpoint has %r)"%(name, settings[name], stored.get(name))
+                   for name in sorted(settings) if stored.get(name) != settings[name]]
+        if changed:
+            raise ValueError("The checkpoint in %s is from a run with different settings: %s."
+                             %(checkpoint_dir, ", ".join(changed)))
+        splits = [(heldinds, list(set(range(nresp))-set(heldinds)))
+                  for heldinds in np.load(paths["valinds"]).tolist()]
+        logger.info("Resuming from checkpoint, %d of %d bootstraps are done.."%(done.sum(), len(done)))
+    else:
+        if not os.path.exists(checkpoint_dir):
+            os.makedirs(checkpoint_dir)
+        np.save(paths["alphas"], alphas)
+        with open(settingspath, "w") as f:
+            json.dump(settings, f)
+        np.save(paths["valinds"], np.array([heldinds for heldinds, notheldinds in splits]))
+        Rcorrs = np.lib.format.open_memmap(paths["bootstrap_corrs"], mode="w+",
+                                           dtype=np.float64 if dtype is None else dtype, shape=shape)
+        ## The flags are created last, so that a checkpoint is only resumed once it is complete
+        done = np.lib.format.open_memmap(paths["bootstrap_done"], mode="w+", dtype=bool, shape=(len(splits),))
+    return Rcorrs, done, splits
+
+
+def _mark_done(Rcorrs, done, bi):
+    """Flushes the stored correlations of bootstrap sample [bi] to disk, then marks it as finished.
+    """
+    Rcorrs.flush()
+    done[bi] = True
+    done.flush()
+
+
+def _mean_bootstrap_corrs(allRcorrs):
+    """Returns the (A, M) mean of the (A, M, B) bootstrap correlations across the bootstrap samples.
+    Memory-mapped correlations are read one bootstrap sample at a time.
+    """
+    if not isinstance(allRcorrs, np.memmap):
+        return allRcorrs.mean(2)
+    meancorrs = np.zeros(allRcorrs.shape[:2])
+    for bi in range(allRcorrs.shape[2]):
+        meancorrs += allRcorrs[:,:,bi]
+    return meancorrs / allRcorrs.shape[2]
+
+
+class FactoredWeights(object):
+    """Ridge weights stored as the product of two low-rank factors, wt = left right, where left (N x r)
+    maps the features into a subspace and right (r x M) holds the coefficients of each response in it.
+    The weights found by ridge() have the form Vh.T diag(S/(S**2+a**2)) U.T resp, so they always fit in
+    the k-dimensional space of the stimulus's right singular vectors. They can be stored in
+    (N + M) k numbers instead of N M, and truncated to an even lower rank (see truncate).
+
+    Predictions are made from the factors directly, (stim left) right, so the dense (N x M) weights are
+    never formed unless dense() is called. Responses can be selected with wt[:,cols] as with a numpy
+    array, which gives FactoredWeights that share the left factor.
+    """
+    def __init__(self, left, right):
+        """Initializes the weights left (N x r) times right (r x M).
+        """
+        if left.shape[1] != right.shape[0]:
+            raise ValueError("left has shape %s, but right has shape %s."%(left.shape, right.shape))
+        self.left = left
+        self.right = right
+
+    def get_shape(self):
+        """Returns the (N, M) shape of the dense weights.
+        """
+        return (self.left.shape[0], self.right.shape[1])
+    shape = property(get_shape)
+
+    def get_rank(self):
+        """Returns the rank r of the factors.
+        """
+        return self.right.shape[0]
+    rank = property(get_rank)
+
+    def get_dtype(self):
+        """Returns the data type of the weights.
+        """
+        return np.result_type(self.left.dtype, self.right.dtype)
+    dtype = property(get_dtype)
+
+    def __getitem__(self, key):
+        """Returns the weights of the responses in wt[:,cols] as FactoredWeights. Only whole columns can
+        be selected.
+        """
+        rows, cols = key
+        if not (isinstance(rows, slice) and rows == slice(None)):
+            raise IndexError("Only response columns can be selected from FactoredWeights, e.g. wt[:,cols].")
+        return FactoredWeights(self.left, self.right[:,cols])
+
+    def predict(self, stim, cols=None):
+        """Returns the predictions (stim wt) for the stimuli [stim] (T x N), for the responses in [cols]
+        (a slice or list of indices) or all of them if [cols] is None. The stimuli are projected onto the
+        left factor first, which costs 2 T r (N + M) FLOPs instead of 2 T N M.
+        """
+        right = self.right if cols is None else self.right[:,cols]
+        return np.dot(np.dot(stim, self.left), right)
+
+    def dense(self, out=None, voxel_chunk=None, max_memory=None):
+        """Returns the dense (N x M) weights, written into [out] if it is given. The columns are formed in
+        blocks (see voxel_blocks).
+        """
+        if out is None:
+            out = np.zeros(self.shape, dtype=self.dtype)
+        elif out.shape != self.shape:
+            raise ValueError("out has shape %s, but the weights have shape %s."%(out.shape, self.shape))
+        for vox in voxel_blocks(self.shape[1], self.shape[0] + self.rank, voxel_chunk=voxel_chunk,
+                                max_memory=max_memory, itemsize=np.dtype(self.dtype).itemsize):
+            out[:,vox] = np.dot(self.left, self.right[:,vox])
+        if isinstance(out, np.memmap):
+            out.flush()
+        return out
+
+    def truncate(self, rank, logger=ridge_logger):
+        """Returns the weights truncated to the given [rank] as new FactoredWeights. If the columns of left
+        are orthonormal (as they are for the weights from ridge), this is the best rank-[rank]
+        approximation of the dense weights: right is projected onto the top [rank] eigenvectors Q of
+        right right.T (r x r), giving left Q and Q.T right.
+        """
+        if rank >= self.rank:
+            return self
+        with stage("truncate", 2 * self.rank**2 * self.shape[1] + 9 * self.rank**3):
+            L, Q = np.linalg.eigh(np.dot(self.right, self.right.T))
+            Q = Q[:,::-1][:,:rank]
+        logger.info("Truncated weights to rank %d, keeping %0.5f of their energy.."
+                    %(rank, L[::-1][:rank].sum() / L.sum()))
+        return FactoredWeights(np.dot(self.left, Q), np.dot(Q.T, self.right))
+
+    def save(self, filename):
+        """Saves the factors at the given filename (an HDF5 file).
+        """
+        import tables
+        ridge_logger.debug("Saving file: %s"%filename)
+        hf = tables.open_file(filename, mode="w", title="FactoredWeights")
+        hf.create_array("/", "left", np.ascontiguousarray(self.left))
+        hf.create_array("/", "right", np.ascontiguousarray(self.right))
+        hf.close()
+
+    @classmethod
+    def load(cls, filename):
+        """Loads weights that were saved with save() from the given filename.
+        """
+        import tables
+        ridge_logger.debug("Loading file: %s"%filename)
+        hf = tables.open_file(filename)
+        wt = cls(hf.get_node("/left").read(), hf.get_node("/right").read())
+        hf.close()
+        return wt
+
+
+class RidgeModel(object):
+    """A fitted ridge model that predicts responses from new, undelayed stimulus features. It holds the
+    weights (a dense (N x M) array or FactoredWeights), the [delays] that were used to build the delayed
+    stimulus with make_delayed (N = F x D for F features and D delays), the mean and standard deviation
+    of each stimulus feature used to z-score it, and optionally the mean and standard deviation of each
+    response used to un-z-score the predictions.
+
+    predict() works on a batch of time points. It sums the product of each shifted copy of the z-scored
+    stimulus with that delay's rows of the weights, so the (T x N) delayed stimulus is never formed.
+    predict_stream() predicts one time point at a time. It keeps the last max(delays)+1 z-scored time
+    points in a ring buffer, so assembling each delayed stimulus vector takes O(D F) work.
+    """
+    def __init__(self, wt, delays=(0,), stim_mean=None, stim_std=None, resp_mean=None, resp_std=None,
+                 alphas=None):
+        """Initializes a model with the weights [wt] for the given [delays]. If [stim_mean] and [stim_std]
+        (F,) are given the stimuli are z-scored with them, and if [resp_mean] and [resp_std] (M,) are given
+        the predictions are multiplied by resp_std and offset by resp_mean. [alphas] (M,) are the ridge
+        parameters, kept for reference.
+        """
+        self.wt = wt
+        self.delays = np.asarray(delays, dtype=int)
+        if wt.shape[0] % len(self.delays):
+            raise ValueError("Weights have %d rows, which is not a multiple of the %d delays."
+                             %(wt.shape[0], len(self.delays)))
+        asarray = lambda arr: None if arr is None else np.asarray(arr)
+        self.stim_mean = asarray(stim_mean)
+        self.stim_std = asarray(stim_std)
+        self.resp_mean = asarray(resp_mean)
+        self.resp_std = asarray(resp_std)
+        self.alphas = asarray(alphas)
+
+    def get_nfeatures(self):
+        """Returns the number F of undelayed stimulus features.
+        """
+        return self.wt.shape[0] // len(self.delays)
+    nfeatures = property(get_nfeatures)
+
+    def get_shape(self):
+        """Returns the (N, M) shape of the weights.
+        """
+        return self.wt.shape
+    shape = property(get_shape)
+
+    def get_factored(self):
+        """Returns True if the weights are FactoredWeights.
+        """
+        return isinstance(self.wt, FactoredWeights)
+    factored = property(get_factored)
+
+    def __getitem__(self, key):
+        """Returns the model for the responses in model[:,cols], as with the weights.
+        """
+        rows, cols = key
+        select = lambda arr: None if arr is None else arr[cols]
+        return RidgeModel(self.wt[:,cols], self.delays, self.stim_mean, self.stim_std,
+                          select(self.resp_mean), select(self.resp_std), select(self.alphas))
+
+    def zscore_stim(self, stim):
+        """Z-scores the undelayed stimuli [stim] (T x F or F,) with the stored feature statistics.
+        """
+        if self.stim_mean is not None:
+            stim = stim - self.stim_mean
+        if self.stim_std is not None:
+            stim = stim / self.stim_std
+        return stim
+
+    def _unzscore_pred(self, pred, cols=None):
+        """Scales and offsets the predictions [pred] for the responses in [cols] with the stored response
+        statistics.
+        """
+        if self.resp_std is not None:
+            pred = pred * (self.resp_std if cols is None else self.resp_std[cols])
+        if self.resp_mean is not None:
+            pred = pred + (self.resp_mean if cols is None else self.resp_mean[cols])
+        return pred
+
+    def _delayed_dot(self, stim, wt):
+        """Returns make_delayed(stim, delays) times [wt] (N x K) without forming the delayed stimulus.
+        """
+        ntime, nfeat = stim.shape
+        out = np.zeros((ntime, wt.shape[1]), dtype=np.result_type(stim.dtype, wt.dtype))
+        for di, d in enumerate(self.delays):
+            dwt = wt[di*nfeat:(di+1)*nfeat]
+            if d >= 0:
+                out[d:] += np.dot(stim[:max(ntime-d, 0)], dwt)
+            else:
+                out[:d] += np.dot(stim[-d:], dwt)
+        return out
+
+    def predict(self, stim, cols=None):
+        """Returns the predicted responses (T x M) for the undelayed stimuli [stim] (T x F), for the
+        responses in [cols] (a slice or list of indices) or all of them if [cols] is None. As with
+        make_delayed, the stimulus is taken to be zero before its first and after its last time point.
+        """
+        stim = self.zscore_stim(np.asarray(stim))
+        if stim.shape[1] != self.nfeatures:
+            raise ValueError("Stimulus has %d features, but the model has %d."%(stim.shape[1], self.nfeatures))
+        if self.factored:
+            right = self.wt.right if cols is None else self.wt.right[:,cols]
+            pred = np.dot(self._delayed_dot(stim, self.wt.left), right)
+        else:
+            pred = self._delayed_dot(stim, self.wt if cols is None else self.wt[:,cols])
+        return self._unzscore_pred(pred, cols)
+
+    def predict_stream(self, trs, cols=None):
+        """Predicts the responses one time point at a time. [trs] is an iterable of undelayed stimulus
+        vectors (F,), e.g. a generator that yields each new TR as it arrives, and this yields the predicted
+        responses (M,) (or those in [cols]) for each one as soon as it is read. Only non-negative delays
+        can be used, since the predictions can't depend on future time points. The results are the same as
+        those of predict() on the stacked time points.
+        """
+        if self.delays.min() < 0:
+            raise ValueError("Streaming prediction needs non-negative delays.")
+        nfeat = self.nfeatures
+        buflen = self.delays.max() + 1
+        if self.factored:
+            left = self.wt.left
+            right = self.wt.right if cols is None else self.wt.right[:,cols]
+        else:
+            left = self.wt if cols is None else self.wt[:,cols]
+        
+        ## Row i of the buffer holds the time point t with t % buflen == i, and is zero until it is filled
+        buf = np.zeros((buflen, nfeat), dtype=left.dtype)
+        for ti, tr in enumerate(trs):
+            pos = ti % buflen
+            buf[pos] = self.zscore_stim(np.asarray(tr))
+            dstim = buf[(pos - self.delays) % buflen].ravel()
+            pred = np.dot(dstim, left)
+            if self.factored:
+                pred = np.dot(pred, right)
+            yield self._unzscore_pred(pred, cols)
+
+    def save(self, filename):
+        """Saves the model at the given filename (an HDF5 file).
+        """
+        import tables
+        ridge_logger.debug("Saving file: %s"%filename)
+        hf = tables.open_file(filename, mode="w", title="RidgeModel")
+        if self.factored:
+            hf.create_array("/", "left", np.ascontiguousarray(self.wt.left))
+            hf.create_array("/", "right", np.ascontiguousarray(self.wt.right))
+        else:
+            hf.create_array("/", "wt", np.asarray(self.wt))
+        hf.create_array("/", "delays", self.delays)
+        for name in ("stim_mean", "stim_std", "resp_mean", "resp_std", "alphas"):
+            if getattr(self, name) is not None:
+                hf.create_array("/", name, np.asarray(getattr(self, name)))
+        hf.close()
+
+    @classmethod
+    def load(cls, filename):
+        """Loads a model that was saved with save() from the given filename.
+        """
+        import tables
+        ridge_logger.debug("Loading file: %s"%filename)
+        hf = tables.open_file(filename)
+        read = lambda name: hf.get_node("/"+name).read() if name in hf.root else None
+        if "wt" in hf.root:
+            wt = read("wt")
+        else:
+            wt = FactoredWeights(read("left"), read("right"))
+        model = cls(wt, read("delays"), read("stim_mean"), read("stim_std"), read("resp_mean"),
+                    read("resp_std"), read("alphas"))
+        hf.close()
+        return model
+
+
+class IncrementalRidge(object):
+    """Ridge regression that is updated with new blocks of data (e.g. new story runs) without refitting
+    from scratch. Only the sufficient statistics are kept: the stimulus Gram matrix G = stim.T stim
+    (N x N), the stimulus-response cross-products C = stim.T resp (N x M), and the number of time
+    points. Folding in a block of T' time points costs O(T' N (N + M)), no matter how much data has
+    been seen before. The weights for any alpha are the same as ridge() would give on all of the data
+    concatenated, up to floating-point rounding.
+
+    Each new block is also used as a held-out test set for the model fit to all of the earlier
+    blocks, before it is folded in. The held-out correlations are accumulated for every alpha in
+    [alphas] (weighted by block length), and best_alphas() picks the best alpha for each response.
+    """
+    def __init__(self, alphas, singcutoff=1e-10, normalpha=False, voxel_chunk=None, max_memory=None,
+                 dtype=None, logger=ridge_logger):
+        """Initializes an empty IncrementalRidge model that will test the ridge parameters [alphas].
+        [singcutoff], [normalpha] and [dtype] are used as in ridge(), and [voxel_chunk] and
+        [max_memory] set the size of the response blocks that are processed at once.
+        """
+        self.alphas = np.asarray(alphas)
+        self.singcutoff = singcutoff
+        self.normalpha = normalpha
+        self.voxel_chunk = voxel_chunk
+        self.max_memory = max_memory
+        self.dtype = dtype
+        self.logger = logger
+        
+        self.G = None ## stimulus Gram matrix, (N x N)
+        self.C = None ## stimulus-response cross-products, (N x M)
+        self.ntime = 0 ## number of time points folded in
+        self.corrsum = None ## held-out correlations times block lengths, (A x M)
+        self.ntested = 0 ## number of held-out time points
+        self._eig = None
+
+    def get_shape(self):
+        """Returns the (N, M) shape of the weights.
+        """
+        return None if self.C is None else self.C.shape
+    shape = property(get_shape)
+
+    def update(self, stim, resp, score=True):
+        """Folds the block of stimuli [stim] (T' x N) and responses [resp] (T' x M) into the model. The
+        responses can be a lazy array (see ridge_utils.read_columns). If [score] is True and the model
+        already holds data, the block is first used to test every alpha.
+        """
+        stim = _as_dtype(stim, self.dtype)
+        nfeat, nvox = stim.shape[1], resp.shape[1]
+        if self.C is None:
+            dtype = np.result_type(stim.dtype, resp.dtype) if self.dtype is None else self.dtype
+            self.G = np.zeros((nfeat, nfeat), dtype=dtype)
+            self.C = np.zeros((nfeat, nvox), dtype=dtype)
+            self.corrsum = np.zeros((len(self.alphas), nvox), dtype=dtype)
+        elif (nfeat, nvox) != self.shape:
+            raise ValueError("Block has %d features and %d responses, but the model has shape %s."
+                             %(nfeat, nvox, str(self.shape)))
+        
+        score = score and self.ntime > 0
+        if score:
+            V, S = self._get_eig()
+            nalphas = self._norm_alphas(self.alphas, S)
+            SV = np.dot(stim, V)
+        
+        blocks = voxel_blocks(nvox, 3 * stim.shape[0] + nfeat, voxel_chunk=self.voxel_chunk,
+                              max_memory=self.max_memory, itemsize=self.C.dtype.itemsize)
+        getblock = lambda vox: np.nan_to_num(read_columns(resp, vox, dtype=self.dtype))
+        for vox, bresp in zip(blocks, prefetch(getblock, blocks)):
+            if score:
+                ## Test each alpha on this block using the model fit to the earlier blocks
+                VC = np.dot(V.T, self.C[:,vox])
+                zresp = zs(bresp)
+                for ai, alpha in enumerate(nalphas):
+                    pred = np.dot(SV / (S**2 + alpha**2), VC)
+                    corr = np.nan_to_num((zresp * zs(pred)).mean(0))
+                    self.corrsum[ai,vox] += stim.shape[0] * corr
+            self.C[:,vox] += np.dot(stim.T, bresp)
+        
+        self.G += np.dot(stim.T, stim)
+        if score:
+            self.ntested += stim.shape[0]
+        self.ntime += stim.shape[0]
+        self._eig = None
+        self.logger.info("Folded in %d time points (%d total).."%(stim.shape[0], self.ntime))
+
+    def get_heldout_corrs(self):
+        """Returns the (A x M) held-out correlation of each alpha for each response, averaged across
+        the scored blocks, or None if no block has been scored yet.
+        """
+        if not self.ntested:
+            return None
+        return self.corrsum / self.ntested
+    heldout_corrs = property(get_heldout_corrs)
+
+    def best_alphas(self, joined=None):
+        """Returns the alpha with the best held-out correlation for each response. If [joined] is given
+        it should be a list of lists of responses that should share one alpha, as in bootstrap_ridge.
+        """
+        corrs = self.heldout_corrs
+        if corrs is None:
+            raise ValueError("At least two blocks must be folded in to choose alphas.")
+        if joined is None:
+            return self.alphas[np.argmax(corrs, 0)]
+        
+        valphas = np.zeros((corrs.shape[1],))
+        for jl in joined:
+            valphas[jl] = self.alphas[np.argmax(corrs[:,jl].mean(1))]
+        return valphas
+
+    def weights(self, alpha=None, out=None):
+        """Returns the (N x M) ridge weights for all of the data folded in so far, using [alpha] (a single
+        value or one per response) or the best_alphas() if [alpha] is None. The weights are written into
+        [out] if it is given (see ridge).
+        """
+        if alpha is None:
+            alpha = self.best_alphas()
+        nfeat, nvox = self.shape
+        if isinstance(alpha, (float,int)):
+            alpha = np.ones(nvox) * alpha
+        
+        V, S = self._get_eig()
+        ualphas, alphainds = np.unique(self._norm_alphas(alpha, S), return_inverse=True)
+        shrink = 1 / (S[:,None]**2 + ualphas**2)
+        
+        if out is None:
+            wt = np.zeros((nfeat, nvox), dtype=S.dtype)
+        elif out.shape != (nfeat, nvox):
+            raise ValueError("out has shape %s, but the weights have shape %s."%(out.shape, (nfeat, nvox)))
+        else:
+            wt = out
+        
+        ## With G = V S**2 V.T, the ridge weights are V diag(1/(S**2+a**2)) V.T C
+        for vox in voxel_blocks(nvox, 2 * S.shape[0] + nfeat, voxel_chunk=self.voxel_chunk,
+                                max_memory=self.max_memory, itemsize=S.dtype.itemsize):
+            VC = np.dot(V.T, self.C[:,vox])
+            VC *= shrink[:,alphainds[vox]]
+            wt[:,vox] = np.dot(V, VC)
+        
+        if isinstance(wt, np.memmap):
+            wt.flush()
+        return wt
+
+    def _get_eig(self):
+        """Returns the eigendecomposition of the Gram matrix (see _gram_eig), computing it only once
+        after each update.
+        """
+        if self.G is None:
+            raise ValueError("No data has been folded in yet.")
+        if self._eig is None:
+            self._eig = _gram_eig(self.G, self.singcutoff, self.logger)
+        return self._eig
+
+    def _norm_alphas(self, alphas, S):
+        """Returns [alphas] normalized by the LSV norm if [normalpha], in the type of [S].
+        """
+        if self.normalpha:
+            alphas = alphas * S[0]
+        return np.asarray(alphas, dtype=S.dtype)
+
+    def save(self, filename):
+        """Saves the sufficient statistics and held-out correlations of this model at the given filename
+        (an HDF5 file), so that more blocks can be folded in later.
+        """
+        import tables
+        self.logger.debug("Saving file: %s"%filename)
+        hf = tables.open_file(filename, mode="w", title="IncrementalRidge")
+        hf.create_array("/", "alphas", self.alphas)
+        if self.C is not None:
+            hf.create_array("/", "G", self.G)
+            hf.create_array("/", "C", self.C)
+            hf.create_array("/", "corrsum", self.corrsum)
+        hf.root._v_attrs.ntime = self.ntime
+        hf.root._v_attrs.ntested = self.ntested
+        hf.root._v_attrs.singcutoff = self.singcutoff
+        hf.root._v_attrs.normalpha = self.normalpha
+        hf.close()
+
+    @classmethod
+    def load(cls, filename, voxel_chunk=None, max_memory=None, dtype=None, logger=ridge_logger):
+        """Loads a model that was saved with save() from the given filename.
+        """
+        import tables
+        logger.debug("Loading file: %s"%filename)
+        hf = tables.open_file(filename)
+        attrs = hf.root._v_attrs
+        model = cls(hf.get_node("/alphas").read(), singcutoff=attrs.singcutoff,
+                    normalpha=bool(attrs.normalpha), voxel_chunk=voxel_chunk, max_memory=max_memory,
+                    dtype=dtype, logger=logger)
+        if "G" in hf.root:
+            model.G = hf.get_node("/G").read()
+            model.C = hf.get_node("/C").read()
+            model.corrsum = hf.get_node("/corrsum").read()
+        model.ntime = int(attrs.ntime)
+        model.ntested = int(attrs.ntested)
+        hf.close()
+        return model
+
+
+def test_float32_tolerance(wt_tol=1e-4, corr_tol=1e-4):
+    """Runs ridge, ridge_corr, ridge_corr_pred and bootstrap_ridge on the same z-scored dataset with
+    dtype=np.float32 and with float64, and checks that the float32 weights agree to within [wt_tol]
+    (relative to the largest weight) and the correlations to within [corr_tol]. This is checked for a
+    tall, well-conditioned stimulus and for a wide (N > T), rank-deficient one.
+    """
+    P = 150 ## test time points
+    M = 300 ## responses
+    snr = 0.5 ## signal to noise ratio
+    alphas = np.logspace(0, 3, 10)
+    
+    ## (training time points, features, stimulus rank, held-out chunks per bootstrap)
+    for T, N, rank, nchunks in [(600, 60, None, 10), (200, 600, 80, 3)]:
+        ## Create the datasets
+        rng = np.random.RandomState(0)
+        truewt = rng.randn(N, M)
+        if rank is None:
+            Rstim = zs(rng.randn(T, N))
+            Pstim = zs(rng.randn(P, N))
+        else:
+            basis = rng.randn(rank, N)
+            Rstim = zs(np.dot(rng.randn(T, rank), basis))
+            Pstim = zs(np.dot(rng.randn(P, rank), basis))
+        Rresp = zs(snr * np.dot(Rstim, truewt) / np.sqrt(N) + rng.randn(T, M))
+        Presp = zs(snr * np.dot(Pstim, truewt) / np.sqrt(N) + rng.randn(P, M))
+        valphas = alphas[rng.randint(len(alphas), size=M)]
+        shape = "T=%d, N=%d"%(T, N)
+        
+        ## Fit everything in both precisions
+        wt64 = ridge(Rstim, Rresp, valphas)
+        wt32 = ridge(Rstim, Rresp, valphas, dtype=np.float32)
+        corrs64 = ridge_corr(Rstim, Pstim, Rresp, Presp, alphas)
+        corrs32 = ridge_corr(Rstim, Pstim, Rresp, Presp, alphas, dtype=np.float32)
+        pcorrs64 = ridge_corr_pred(Rstim, Pstim, Rresp, Presp, valphas)
+        pcorrs32 = ridge_corr_pred(Rstim, Pstim, Rresp, Presp, valphas, dtype=np.float32)
+        boot64 = bootstrap_ridge(Rstim, Rresp, Pstim, Presp, alphas, 5, 10, nchunks, seed=0)
+        boot32 = bootstrap_ridge(Rstim, Rresp, Pstim, Presp, alphas, 5, 10, nchunks, seed=0, dtype=np.float32)
+        
+        ## Compare them
+        wterr = np.abs(wt32 - wt64).max() / np.abs(wt64).max()
+        correrr = np.abs(corrs32 - corrs64).max()
+        pcorrerr = np.abs(pcorrs32 - pcorrs64).max()
+        bootcorrerr = np.abs(boot32[3] - boot64[3]).max()
+        assert all(arr.dtype == np.float32 for arr in (wt32, corrs32, pcorrs32, boot32[0], boot32[1]))
+        assert wterr < wt_tol, "ridge weights differ by %g (%s)"%(wterr, shape)
+        assert correrr < corr_tol, "ridge_corr correlations differ by %g (%s)"%(correrr, shape)
+        assert pcorrerr < corr_tol, "ridge_corr_pred correlations differ by %g (%s)"%(pcorrerr, shape)
+        assert bootcorrerr < corr_tol, ("bootstrap_ridge bootstrap correlations differ by %g (%s)"
+                                        %(bootcorrerr, shape))
+        assert np.array_equal(boot32[2], boot64[2]), "bootstrap_ridge chose different alphas (%s)"%shape
+        bootwterr = np.abs(boot32[0] - boot64[0]).max() / np.abs(boot64[0]).max()
+        bootpcorrerr = np.abs(boot32[1] - boot64[1]).max()
+        assert bootwterr < wt_tol, "bootstrap_ridge weights differ by %g (%s)"%(bootwterr, shape)
+        assert bootpcorrerr < corr_tol, ("bootstrap_ridge prediction correlations differ by %g (%s)"
+                                         %(bootpcorrerr, shape))
+    
+    return locals()
@@ -0,0 +1,267 @@
+"""Benchmarks for the ridge regression functions in ridge.py, run on synthetic data.
+
+Run this module as a script to print the results, e.g.:
+
+    python ridge_benchmark.py randomized --T 5000 --N 2000 --M 10000
+
+The "suite" benchmark times ridge, ridge_corr, ridge_corr_pred, bootstrap_ridge and make_delayed
+over a grid of problem shapes, and records their peak memory. Its results can be saved as a baseline
+and later runs compared against it, e.g.:
+
+    python ridge_benchmark.py suite --preset small --save baseline.json
+    python ridge_benchmark.py suite --preset small --compare baseline.json
+
+A reference baseline for the small preset is stored in ridge_benchmark_baseline.json, which --compare
+uses when no file is given. Its times were measured on one machine (described in its "meta" entry), so
+on other hardware a local baseline should be saved first and compared against instead.
+"""
+import sys
+import json
+import time
+import platform
+import itertools
+import tracemalloc
+import logging
+import argparse
+import os
+import numpy as np
+
+import ridge
+from ridge_utils import make_delayed
+
+def make_stimulus(T, N, decay=0.05, seed=0):
+    """Creates a synthetic (T x N) stimulus matrix whose singular values decay exponentially at the
+    rate [decay], like the delayed feature spaces used in the encoding model tutorials.
+    """
+    rng = np.random.RandomState(seed)
+    k = min(T, N)
+    U = np.linalg.qr(rng.randn(T, k))[0]
+    V = np.linalg.qr(rng.randn(N, k))[0]
+    S = np.exp(-decay * np.arange(k)) * np.sqrt(T)
+    return np.dot(U * S, V.T)
+
+def make_problem(T, N, M, TP, decay=0.05, noise=1.0, seed=0):
+    """Creates a synthetic regression problem with training and test stimuli (see make_stimulus) and
+    responses that are a random linear function of the stimuli plus [noise]. Returns Rstim, Pstim,
+    Rresp, Presp.
+    """
+    rng = np.random.RandomState(seed)
+    stim = make_stimulus(T + TP, N, decay=decay, seed=seed)
+    wt = rng.randn(N, M) / np.sqrt(N)
+    resp = np.dot(stim, wt)
+    resp += noise * resp.std() * rng.randn(T + TP, M)
+    return stim[:T], stim[T:], resp[:T], resp[T:]
+
+def timed(func, *args, **kwargs):
+    """Calls func(*args, **kwargs). Returns the result and the wall time it took in seconds.
+    """
+    start_time = time.perf_counter()
+    result = func(*args, **kwargs)
+    return result, time.perf_counter() - start_time
+
+def benchmark_randomized(T=2000, N=1000, M=2000, TP=200, ranks=(25, 50, 100, 200), energies=(0.9, 0.99),
+                         alphas=np.logspace(0, 3, 20), decay=0.05, seed=0):
+    """Compares the speed and accuracy of ridge_corr and ridge_corr_pred with the randomized SVD solver
+    against the exact "svd" solver, for each rank in [ranks] and energy target in [energies].
+    Returns a list of dicts with the solver settings, run times, and the largest absolute difference
+    between the approximate and exact correlations.
+    """
+    Rstim, Pstim, Rresp, Presp = make_problem(T, N, M, TP, decay=decay, seed=seed)
+    valphas = alphas[np.random.RandomState(seed).randint(len(alphas), size=M)]
+
+    exact_corr, corr_time = timed(ridge.ridge_corr, Rstim, Pstim, Rresp, Presp, alphas, solver="svd")
+    exact_pred, pred_time = timed(ridge.ridge_corr_pred, Rstim, Pstim, Rresp, Presp, valphas, solver="svd")
+    results = [dict(solver="svd", rank=min(T, N), energy=1.0,
+                    corr_time=corr_time, pred_time=pred_time, corr_err=0.0, pred_err=0.0)]
+
+    settings = [dict(svd_rank=r) for r in ranks] + [dict(svd_energy=e) for e in energies]
+    for setting in settings:
+        corr, corr_time = timed(ridge.ridge_corr, Rstim, Pstim, Rresp, Presp, alphas,
+                                solver="randomized", **setting)
+        pred, pred_time = timed(ridge.ridge_corr_pred, Rstim, Pstim, Rresp, Presp, valphas,
+                                solver="randomized", **setting)
+        results.append(dict(solver="randomized", rank=setting.get("svd_rank"),
+                            energy=setting.get("svd_energy"), corr_time=corr_time, pred_time=pred_time,
+                            corr_err=np.abs(corr - exact_corr).max(),
+                            pred_err=np.abs(pred - exact_pred).max()))
+    return results
+
+def traced(func, *args, **kwargs):
+    """Calls func(*args, **kwargs) while tracing memory allocations. Returns the result and the peak
+    memory allocated during the call in bytes (numpy arrays are traced too). Tracing slows the call
+    down, so its time should be measured in a separate run (see timed).
+    """
+    tracemalloc.start()
+    try:
+        result = func(*args, **kwargs)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return result, peak
+
+## Problem shapes for the suite benchmark. Each entry lists the values of T (training time points),
+## N (features), M (responses), A (alphas) and B (bootstrap samples) to sweep; every combination is run.
+presets = dict(
+    small=dict(T=[1000], N=[100, 1000], M=[1000], A=[10], B=[5]),
+    medium=dict(T=[1000, 5000], N=[100, 1000, 4000], M=[10000], A=[10, 20], B=[10]),
+    large=dict(T=[1000, 5000, 20000], N=[100, 1000, 10000], M=[1000, 10000, 100000], A=[20], B=[15]),
+)
+
+suite_functions = ["ridge", "ridge_corr", "ridge_corr_pred", "bootstrap_ridge", "make_delayed"]
+
+def benchmark_case(function, T, N, M, A, B, TP=None, delays=(1, 2, 3, 4), repeat=5, seed=0):
+    """Runs one [function] from the suite on a synthetic problem with the given shape (see presets).
+    The test set has [TP] time points (T/10 by default). make_delayed is run on a (T x N/len(delays))
+    stimulus, so that its output has about N features. The function is timed [repeat] times, and its
+    peak memory is traced in one more run. Returns a dict with the shape, the fastest wall time and the
+    peak memory in MB.
+    """
+    TP = max(T // 10, 10) if TP is None else TP
+    alphas = np.logspace(0, 3, A)
+    if function == "make_delayed":
+        stim = np.random.RandomState(seed).randn(T, max(N // len(delays), 1))
+        args, kwargs = (stim, delays), dict()
+        func = make_delayed
+    else:
+        Rstim, Pstim, Rresp, Presp = make_problem(T, N, M, TP, seed=seed)
+        valphas = alphas[np.random.RandomState(seed).randint(A, size=M)]
+        func = getattr(ridge, function)
+        kwargs = dict()
+        if function == "ridge":
+            args = (Rstim, Rresp, valphas)
+        elif function == "ridge_corr":
+            args = (Rstim, Pstim, Rresp, Presp, alphas)
+        elif function == "ridge_corr_pred":
+            args = (Rstim, Pstim, Rresp, Presp, valphas)
+        elif function == "bootstrap_ridge":
+            chunklen = 10
+            args = (Rstim, Rresp, Pstim, Presp, alphas, B, chunklen, max(T // 5 // chunklen, 1))
+            kwargs = dict(seed=seed)
+        else:
+            raise ValueError("Unknown function %r, should be one of %s."%(function, ", ".join(suite_functions)))
+    
+    seconds = min(timed(func, *args, **kwargs)[1] for r in range(max(repeat, 1)))
+    result, peak = traced(func, *args, **kwargs)
+    return dict(function=function, T=T, N=N, M=M, A=A, B=B, time=seconds, peak_mb=peak / 2.0**20)
+
+def benchmark_suite(grid, functions=suite_functions, repeat=5, seed=0):
+    """Runs benchmark_case for each function in [functions] and every combination of the shapes in
+    [grid] (a dict like those in presets). Cases that do not depend on A or B are only run once for each
+    shape. Each case is timed [repeat] times and the fastest time is kept. Returns a list of result dicts.
+    """
+    results = []
+    for function in functions:
+        seen = set()
+        for T, N, M, A, B in itertools.product(grid["T"], grid["N"], grid["M"], grid["A"], grid["B"]):
+            ## Only bootstrap_ridge depends on the bootstrap count, and make_delayed only on T and N
+            if function != "bootstrap_ridge":
+                B = 0
+            if function == "make_delayed":
+                A, M = 0, 0
+            if (T, N, M, A, B) in seen:
+                continue
+            seen.add((T, N, M, A, B))
+            
+            best = dict(benchmark_case(function, T, N, M, max(A, 1), B, repeat=repeat, seed=seed), A=A)
+            logging.getLogger("ridge_benchmark").info("%s: %0.3f seconds"%(case_name(best), best["time"]))
+            results.append(best)
+    return results
+
+def case_name(result):
+    """Returns a string naming the function and shape of a benchmark [result].
+    """
+    return "%s(T=%d, N=%d, M=%d, A=%d, B=%d)"%tuple(result[k] for k in ("function", "T", "N", "M", "A", "B"))
+
+def save_results(results, filename):
+    """Saves benchmark [results] to the JSON file [filename], with a description of the machine, so that
+    they can be used as a baseline.
+    """
+    meta = dict(numpy=np.__version__, python=platform.python_version(), machine=platform.platform(),
+                processor=platform.processor(), time=time.strftime("%Y-%m-%d %H:%M:%S"))
+    with open(filename, "w") as f:
+        json.dump(dict(meta=meta, results=results), f, indent=1)
+
+## Reference results for the small preset, see the module docstring
+default_baseline = os.path.join(os.path.dirname(os.path.abspath(__file__)), "ridge_benchmark_baseline.json")
+
+def load_results(filename):
+    """Loads benchmark results that were saved with save_results. Returns the list of results.
+    """
+    with open(filename) as f:
+        return json.load(f)["results"]
+
+def compare_results(results, baseline, tolerance=0.3, min_seconds=0.05):
+    """Compares benchmark [results] to the [baseline] results for the same cases. Returns a list of dicts
+    with the time and peak memory of both and their ratios (new / baseline), and a "regression" flag
+    that is set when either ratio is more than 1 + [tolerance]. A slowdown of less than [min_seconds] is
+    not counted, since the times of the smallest cases are mostly timer noise. Cases missing from the
+    baseline are skipped.
+    """
+    key = lambda res: tuple(res[k] for k in ("function", "T", "N", "M", "A", "B"))
+    basedict = dict((key(res), res) for res in baseline)
+    comparison = []
+    for res in results:
+        base = basedict.get(key(res))
+        if base is None:
+            continue
+        time_ratio = res["time"] / base["time"] if base["time"] > 0 else np.inf
+        mem_ratio = res["peak_mb"] / base["peak_mb"] if base["peak_mb"] > 0 else np.inf
+        slower = time_ratio > 1 + tolerance and res["time"] - base["time"] > min_seconds
+        comparison.append(dict(res, base_time=base["time"], base_peak_mb=base["peak_mb"],
+                               time_ratio=time_ratio, mem_ratio=mem_ratio,
+                               regression=slower or mem_ratio > 1 + tolerance))
+    return comparison
+
+def print_table(results, columns):
+    """Prints the dicts in [results] as a table with the given [columns].
+    """
+    print (" ".join("%12s"%c for c in columns))
+    for res in results:
+        vals = [res.get(c) for c in columns]
+        print (" ".join("%12s"%("-" if v is None else ("%0.4g"%v if isinstance(v, float) else v))
+                        for v in vals))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("benchmark", choices=["randomized", "suite"])
+    parser.add_argument("--T", type=int, nargs="+", default=None)
+    parser.add_argument("--N", type=int, nargs="+", default=None)
+    parser.add_argument("--M", type=int, nargs="+", default=None)
+    parser.add_argument("--A", type=int, nargs="+", default=None, help="alpha grid sizes (suite)")
+    parser.add_argument("--B", type=int, nargs="+", default=None, help="bootstrap counts (suite)")
+    parser.add_argument("--TP", type=int, default=200)
+    parser.add_argument("--decay", type=float, default=0.05)
+    parser.add_argument("--preset", choices=sorted(presets), default="small")
+    parser.add_argument("--functions", nargs="+", choices=suite_functions, default=suite_functions)
+    parser.add_argument("--repeat", type=int, default=5, help="timing runs per case, the fastest is kept (suite)")
+    parser.add_argument("--save", help="save the suite results to this JSON file")
+    parser.add_argument("--compare", nargs="?", const=default_baseline,
+                        help="compare the suite results to the baseline in this JSON file "
+                             "(default: the stored small preset baseline)")
+    parser.add_argument("--tolerance", type=float, default=0.3)
+    parser.add_argument("--min-seconds", type=float, default=0.05, help="smallest slowdown counted as a regression")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    if args.benchmark == "randomized":
+        first = lambda vals, default: default if vals is None else vals[0]
+        results = benchmark_randomized(T=first(args.T, 2000), N=first(args.N, 1000), M=first(args.M, 2000),
+                                       TP=args.TP, decay=args.decay)
+        print_table(results, ["solver", "rank", "energy", "corr_time", "pred_time", "corr_err", "pred_err"])
+    elif args.benchmark == "suite":
+        grid = dict(presets[args.preset])
+        for dim in ("T", "N", "M", "A", "B"):
+            if getattr(args, dim) is not None:
+                grid[dim] = getattr(args, dim)
+        results = benchmark_suite(grid, functions=args.functions, repeat=args.repeat)
+        if args.save:
+            save_results(results, args.save)
+        if args.compare:
+            comparison = compare_results(results, load_results(args.compare), tolerance=args.tolerance,
+                                         min_seconds=args.min_seconds)
+            print_table(comparison, ["function", "T", "N", "M", "A", "B", "time", "base_time", "time_ratio",
+                                     "peak_mb", "base_peak_mb", "mem_ratio", "regression"])
+            if any(comp["regression"] for comp in comparison):
+                sys.exit(1)
+        else:
+            print_table(results, ["function", "T", "N", "M", "A", "B", "time", "peak_mb"])
@@ -4,49 +4,39 @@ import numpy as np
 import random
 import sys
 import os
+from npp import normalize, unnormalize
 
-def zscore(mat, return_unzvals=False):
+def zscore(mat, return_unzvals=False, out=None, chunk=None):
     """Z-scores the rows of [mat] by subtracting off the mean and dividing
     by the standard deviation.
     If [return_unzvals] is True, a matrix will be returned that can be used
     to return the z-scored values to their original state.
+    [out] and [chunk] are passed to npp.normalize (e.g. out=mat works in place).
     """
-    zmat = np.empty(mat.shape, mat.dtype)
-    unzvals = np.zeros((zmat.shape[0], 2), mat.dtype)
-    for ri in range(mat.shape[0]):
-        unzvals[ri,0] = np.std(mat[ri,:])
-        unzvals[ri,1] = np.mean(mat[ri,:])
-        zmat[ri,:] = (mat[ri,:]-unzvals[ri,1]) / (1e-10+unzvals[ri,0])
+    zmat, (means, stds) = normalize(mat, axis=1, eps=1e-10, out=out, chunk=chunk, return_stats=True)
     
     if return_unzvals:
-        return zmat, unzvals
+        return zmat, np.column_stack([stds, means])
     
     return zmat
 
-def center(mat, return_uncvals=False):
+def center(mat, return_uncvals=False, out=None, chunk=None):
     """Centers the rows of [mat] by subtracting off the mean, but doesn't 
     divide by the SD.
     Can be undone like zscore.
     """
-    cmat = np.empty(mat.shape)
-    uncvals = np.ones((mat.shape[0], 2))
-    for ri in range(mat.shape[0]):
-        uncvals[ri,1] = np.mean(mat[ri,:])
-        cmat[ri,:] = mat[ri,:]-uncvals[ri,1]
+    cmat, (means, stds) = normalize(mat, axis=1, scale=False, out=out, chunk=chunk, return_stats=True)
     
     if return_uncvals:
-        return cmat, uncvals
+        return cmat, np.column_stack([stds, means])
     
     return cmat
 
-def unzscore(mat, unzvals):
+def unzscore(mat, unzvals, out=None, chunk=None):
     """Un-Z-scores the rows of [mat] by multiplying by unzvals[:,0] (the standard deviations)
     and then adding unzvals[:,1] (the row means).
     """
-    unzmat = np.empty(mat.shape)
-    for ri in range(mat.shape[0]):
-        unzmat[ri,:] = mat[ri,:]*(1e-10+unzvals[ri,0])+unzvals[ri,1]
-    return unzmat
+    return unnormalize(mat, (unzvals[:,1], unzvals[:,0]), axis=1, eps=1e-10, out=out, chunk=chunk)
 
 def ridge(A, b, alpha):
     """Performs ridge regression, estimating x in Ax=b with a regularization
@@ -144,6 +134,175 @@ def make_delayed(stim, delays, circpad=False):
         dstims.append(dstim)
     return np.hstack(dstims)
 
+class DelayedMatrix(object):
+    """The delayed stimulus make_delayed(stim, delays) (T x F*D for F features and D delays, with zero
+    padding), as an operator that is never formed. Products are computed from shifted views of [stim],
+    so an 8-delay stimulus takes the memory of 1 delay. It supports:
+    
+      X.dot(mat), X @ mat   -- (T x F*D) times (F*D x K), as D products of shifted stim blocks
+      X.T.dot(mat), X.T @ mat -- (F*D x T) times (T x K)
+      X.gram()              -- X.T X, from one product per lag between delays
+      X.kernel()            -- X X.T, from the single product stim stim.T
+      X.sqnorm()            -- the sum of squares of X
+      X[rows, cols]         -- a dense block, gathered from stim
+      X.toarray()           -- the dense delayed matrix (for code that needs one)
+    
+    np.asarray(X) raises a TypeError, so that code that would silently form the delayed matrix fails
+    instead. Call X.toarray() to form it on purpose.
+    
+    The ridge functions accept it in place of a dense stimulus.
+    """
+    ndim = 2
+    
+    def __init__(self, stim, delays):
+        """Represents make_delayed([stim], [delays]).
+        """
+        self.stim = np.asarray(stim)
+        self.delays = [int(d) for d in delays]
+        self.shape = (self.stim.shape[0], self.stim.shape[1] * len(self.delays))
+        self.dtype = self.stim.dtype
+    
+    def astype(self, dtype):
+        """Returns the delayed matrix of stim converted to [dtype].
+        """
+        return DelayedMatrix(self.stim.astype(dtype), self.delays)
+    
+    def _views(self, d):
+        """Returns the (target, source) row slices for delay [d]: row t of the delayed block is row t-d of
+        stim, for the rows in target.
+        """
+        ntime = self.stim.shape[0]
+        if d >= 0:
+            return slice(min(d, ntime), ntime), slice(0, max(ntime-d, 0))
+        return slice(0, max(ntime+d, 0)), slice(min(-d, ntime), ntime)
+    
+    def _cols(self, di):
+        """Returns the columns that belong to the delay with index [di].
+        """
+        nfeat = self.stim.shape[1]
+        return slice(di*nfeat, (di+1)*nfeat)
+    
+    def dot(self, mat):
+        """Returns the delayed matrix times [mat] (F*D x K or F*D,).
+        """
+        mat = np.asarray(mat)
+        out = np.zeros((self.shape[0],) + mat.shape[1:], dtype=np.result_type(self.dtype, mat.dtype))
+        for di, d in enumerate(self.delays):
+            target, source = self._views(d)
+            out[target] += np.dot(self.stim[source], mat[self._cols(di)])
+        return out
+    __matmul__ = dot
+    
+    def tdot(self, mat):
+        """Returns the transpose of the delayed matrix times [mat] (T x K or T,).
+        """
+        mat = np.asarray(mat)
+        out = np.zeros((self.shape[1],) + mat.shape[1:], dtype=np.result_type(self.dtype, mat.dtype))
+        for di, d in enumerate(self.delays):
+            target, source = self._views(d)
+            out[self._cols(di)] = np.dot(self.stim[source].T, mat[target])
+        return out
+    
+    @property
+    def T(self):
+        """The transpose of the delayed matrix, as an operator with dot and @.
+        """
+        return _DelayedTranspose(self)
+    
+    def gram(self):
+        """Returns the (F*D x F*D) Gram matrix X.T X. Block (i, j) is the sum over t of
+        stim[t-d_i].T stim[t-d_j], which only depends on the lag d_j-d_i up to the few rows at the edges
+        that are zero-padded. So the full product for each lag is found once, and the edge rows are
+        subtracted for each pair of delays.
+        """
+        ntime, nfeat = self.stim.shape
+        stim = self.stim
+        G = np.zeros(self.shape[1:]*2, dtype=self.dtype)
+        lagprods = {}
+        for i, di in enumerate(self.delays):
+            for j, dj in enumerate(self.delays):
+                lag = dj - di
+                if lag < 0 or (lag == 0 and j < i):
+                    continue
+                if lag not in lagprods:
+                    ## sum over u of stim[u+lag].T stim[u]
+                    lagprods[lag] = np.dot(stim[lag:].T, stim[:max(ntime-lag, 0)])
+                ## Rows t where both delayed rows are in range, as rows u = t-dj of the lag product
+                nrows = max(ntime - lag, 0)
+                lo = min(max(0, -dj), nrows)
+                hi = max(min(ntime - dj, nrows), lo)
+                block = lagprods[lag].copy()
+                if lo > 0:
+                    block -= np.dot(stim[lag:lag+lo].T, stim[:lo])
+                if hi < nrows:
+                    block -= np.dot(stim[hi+lag:].T, stim[hi:nrows])
+                G[self._cols(i), self._cols(j)] = block
+                G[self._cols(j), self._cols(i)] = block.T
+        return G
+    
+    def kernel(self):
+        """Returns the (T x T) kernel matrix X X.T, which is the sum over delays of stim stim.T shifted
+        along its diagonal.
+        """
+        base = np.dot(self.stim, self.stim.T)
+        K = np.zeros_like(base)
+        for d in self.delays:
+            target, source = self._views(d)
+            K[target, target] += base[source, source]
+        return K
+    
+    def __getitem__(self, key):
+        """Returns the dense block X[rows, cols] (or X[rows] for all of the columns), gathered from stim.
+        """
+        rows, cols = key if isinstance(key, tuple) else (key, slice(None))
+        ntime, nfeat = self.stim.shape
+        rows = np.arange(ntime)[rows]
+        cols = np.arange(self.shape[1])[cols]
+        source = np.asarray(rows)[...,None] - np.asarray(self.delays)[cols // nfeat]
+        valid = (source >= 0) & (source < ntime)
+        block = self.stim[np.clip(source, 0, ntime-1), cols % nfeat]
+        return np.where(valid, block, 0).astype(self.dtype, copy=False)
+    
+    def sqnorm(self):
+        """Returns the sum of squares of the delayed matrix, from the squared norms of the rows of stim.
+        """
+        rownorms = np.cumsum(np.concatenate([[0], np.einsum("ij,ij->i", self.stim, self.stim)]))
+        return sum(rownorms[src.stop] - rownorms[src.start] for src in (self._views(d)[1] for d in self.delays))
+    
+    def toarray(self):
+        """Returns the dense delayed matrix, like make_delayed.
+        """
+        out = np.zeros(self.shape, dtype=self.dtype)
+        for di, d in enumerate(self.delays):
+            target, source = self._views(d)
+            out[target, self._cols(di)] = self.stim[source]
+        return out
+    
+    def __array__(self, dtype=None, copy=None):
+        raise TypeError("A DelayedMatrix is not converted to an array implicitly, call toarray() to form it.")
+
+class _DelayedTranspose(object):
+    """The transpose of a DelayedMatrix, which supports dot and @.
+    """
+    ndim = 2
+    
+    def __init__(self, delayed):
+        self.delayed = delayed
+        self.shape = delayed.shape[::-1]
+        self.dtype = delayed.dtype
+    
+    def dot(self, mat):
+        return self.delayed.tdot(mat)
+    __matmul__ = dot
+    
+    @property
+    def T(self):
+        return self.delayed
+    
+    def __array__(self, dtype=None, copy=None):
+        raise TypeError("A DelayedMatrix is not converted to an array implicitly, call toarray() to form it.")
+
+
 def mult_diag(d, mtx, left=True):
     """Multiply a full matrix by a diagonal matrix.
     This function should always be faster than dot.
@@ -164,8 +323,125 @@ def mult_diag(d, mtx, left=True):
     else:
         return d*mtx
 
+def randomized_svd(mat, rank, oversample=10, n_iter=2, seed=0, center=None):
+    """Finds an approximate truncated SVD of [mat] with [rank] singular values/vectors using a randomized
+    range finder (Halko, Martinsson & Tropp, 2011). [oversample] extra random directions are used to find
+    the range of [mat], which is refined with [n_iter] power iterations. Good when the spectrum of [mat]
+    decays quickly. Returns U, S, Vh like np.linalg.svd(mat, full_matrices=False), truncated to [rank].
+    If [center] (a row vector) is given, the SVD of mat - center is found without forming it. [mat] can
+    also be an operator with dot and T.dot, like a DelayedMatrix.
+    """
+    if center is None:
+        dot = lambda mat, Q: mat.dot(Q)
+        tdot = lambda Q: mat.T.dot(Q)
+    else:
+        ## (mat - 1 center) times Q, and its transpose times Q
+        dot = lambda mat, Q: mat.dot(Q) - np.dot(center, Q)
+        tdot = lambda Q: mat.T.dot(Q) - np.outer(center, Q.sum(0))
+    rng = np.random.RandomState(seed)
+    nsamp = min(rank + oversample, min(mat.shape))
+    Q = dot(mat, rng.standard_normal((mat.shape[1], nsamp)).astype(mat.dtype))
+    Q = np.linalg.qr(Q)[0]
+    for it in range(n_iter):
+        ## Re-orthonormalize after each multiplication to keep the small singular directions
+        Q = np.linalg.qr(tdot(Q))[0]
+        Q = np.linalg.qr(dot(mat, Q))[0]
+    
+    Ub, S, Vh = np.linalg.svd(tdot(Q).T, full_matrices=False)
+    return np.dot(Q, Ub[:,:rank]), S[:rank], Vh[:rank]
+
+def voxel_blocks(nvox, nrows, voxel_chunk=None, max_memory=None, itemsize=8):
+    """Splits [nvox] responses into contiguous blocks (a list of slices). If [voxel_chunk] is given each
+    block holds that many responses. Otherwise, if [max_memory] (in bytes) is given, the block size is
+    chosen so that [nrows] values of [itemsize] bytes per response fit in it. If neither is given a single
+    block holding every response is returned.
+    """
+    if voxel_chunk is None:
+        if max_memory is None:
+            voxel_chunk = nvox
+        else:
+            voxel_chunk = int(max_memory // (nrows * itemsize))
+            if voxel_chunk < 1:
+                raise ValueError("max_memory=%d bytes is too small to hold a single response "
+                                 "(%d bytes needed)."%(max_memory, nrows * itemsize))
+    voxel_chunk = max(1, min(voxel_chunk, nvox))
+    return [slice(start, min(start+voxel_chunk, nvox)) for start in range(0, nvox, voxel_chunk)]
+
+def read_columns(arr, cols, rows=None, dtype=None):
+    """Reads the columns in slice [cols] of the 2D array [arr] into memory, keeping only the rows in
+    [rows] (a list of indices) if it is given, and converting them to [dtype] if that is given.
+    [arr] can be a numpy array, an np.memmap, a PyTables array node (e.g. from a file written by
+    util.save_table_file), or any other lazy array that has .shape and .dtype and returns a numpy array
+    for arr[:, start:stop]. Only the requested block of a lazy array is read from disk.
+    """
+    if rows is None:
+        block = arr[:, cols]
+    elif isinstance(arr, np.ndarray):
+        block = arr[rows, cols]
+    else:
+        ## Lazy arrays may not support fancy indexing, so read the whole column block
+        block = np.asarray(arr[:, cols])[rows]
+    return np.asarray(block, dtype=dtype)
+
+class ColumnStack(object):
+    """A lazy array that stacks the columns of several 2D arrays with the same number of rows, like
+    np.hstack([arrays]) but without copying them. The arrays can themselves be lazy (see read_columns).
+    Reading a block of columns only reads the parts of the arrays it overlaps.
+    """
+    def __init__(self, arrays):
+        """Stacks the columns of [arrays].
+        """
+        self.arrays = list(arrays)
+        nrows = set(arr.shape[0] for arr in self.arrays)
+        if len(nrows) != 1:
+            raise ValueError("The arrays should all have the same number of rows, not %s."%sorted(nrows))
+        self.offsets = np.cumsum([0] + [arr.shape[1] for arr in self.arrays])
+        self.shape = (nrows.pop(), int(self.offsets[-1]))
+        self.dtype = np.result_type(*[arr.dtype for arr in self.arrays])
+
+    def __getitem__(self, key):
+        """Returns arr[rows, cols], where [cols] is a slice.
+        """
+        rows, cols = key
+        start, stop, step = cols.indices(self.shape[1])
+        if step != 1:
+            raise IndexError("ColumnStack only supports contiguous column slices.")
+        parts = []
+        for arr, offset in zip(self.arrays, self.offsets):
+            lo, hi = max(start - offset, 0), min(stop - offset, arr.shape[1])
+            if lo < hi:
+                parts.append(np.asarray(arr[rows, lo:hi], dtype=self.dtype))
+        if not parts:
+            return np.empty((self.shape[0], 0), dtype=self.dtype)[rows]
+        return np.hstack(parts)
+
+def prefetch(func, items):
+    """Yields func(item) for each item in [items], computing the result for the next item in a background
+    thread while the current result is being used. This overlaps reading (and any GIL-releasing work
+    like BLAS calls) for the next block of data with the computation on the current one. At most two
+    results are held at once. With a single item no thread is started.
+    """
+    items = list(items)
+    if len(items) < 2:
+        for item in items:
+            yield func(item)
+        return
+
+    from concurrent.futures import ThreadPoolExecutor
+    pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="prefetch")
+    try:
+        future = pool.submit(func, items[0])
+        for item in items[1:]:
+            result = future.result()
+            future = pool.submit(func, item)
+            yield result
+        yield future.result()
+    finally:
+        pool.shutdown(wait=True)
+
 import time
 import logging
+import threading
 def counter(iterable, countevery=100, total=None, logger=logging.getLogger("counter")):
     """Logs a status and timing update to [logger] every [countevery] draws from [iterable].
     If [total] is given, log messages will include the estimated time remaining.
@@ -205,6 +481,138 @@ def counter(iterable, countevery=100, total=None, logger=logging.getLogger("coun
                 logger.info(formatted_str)
 
 
+def peak_rss():
+    """Returns the peak resident memory of this process so far in bytes, or None where that is not
+    available (e.g. on Windows).
+    """
+    try:
+        import resource
+    except ImportError:
+        return None
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxrss if sys.platform == "darwin" else maxrss * 1024 ## kilobytes everywhere but OS X
+
+class StageProfile(object):
+    """Collects the wall time, memory growth and estimated number of floating-point operations (FLOPs)
+    of each stage of a computation, as recorded by the stage() context manager while this profile is
+    active (see profile_stages). Each record is a dict with the stage "name", the name of the "thread"
+    it ran in, its wall "time" in seconds, its "flops" (None if unknown), the process's "peak_rss" in
+    bytes when the stage finished, and "rss_growth", how many bytes the stage raised that peak by.
+    The peak never goes down, so a stage that stays below an earlier peak has no growth. If [callback]
+    is given it is called with each record as it is made.
+
+    Stages run in background threads (e.g. the "UR" products that ridge_corr prefetches) overlap the
+    stages of the main thread, so the stage times can add up to more than the wall time, and memory
+    growth during the overlap is attributed to both.
+    """
+    def __init__(self, callback=None):
+        self.records = []
+        self.callback = callback
+
+    def add(self, name, seconds, flops=None, start_rss=None):
+        """Records a stage called [name] that took [seconds] and did [flops] floating-point operations.
+        [start_rss] is the peak_rss() when the stage started.
+        """
+        end_rss = peak_rss()
+        growth = None if start_rss is None or end_rss is None else end_rss - start_rss
+        record = dict(name=name, thread=threading.current_thread().name, time=seconds, flops=flops,
+                      peak_rss=end_rss, rss_growth=growth)
+        self.records.append(record)
+        if self.callback is not None:
+            self.callback(record)
+
+    def summary(self):
+        """Returns a dict mapping each stage name to the number of times it ran ("count"), its total wall
+        time and FLOPs, its FLOP rate in GFLOP/s, the highest peak_rss seen at its end, its total
+        rss_growth, and the sorted names of the "threads" it ran in.
+        """
+        stages = dict()
+        for rec in self.records:
+            st = stages.setdefault(rec["name"], dict(count=0, time=0.0, flops=0, peak_rss=None,
+                                                     rss_growth=None, threads=set()))
+            st["count"] += 1
+            st["time"] += rec["time"]
+            st["threads"].add(rec["thread"])
+            if rec["flops"] is not None:
+                st["flops"] += rec["flops"]
+            if rec["peak_rss"] is not None:
+                st["peak_rss"] = max(st["peak_rss"] or 0, rec["peak_rss"])
+            if rec["rss_growth"] is not None:
+                st["rss_growth"] = (st["rss_growth"] or 0) + rec["rss_growth"]
+        for st in stages.values():
+            st["gflops"] = st["flops"] / st["time"] / 1e9 if st["time"] > 0 else 0.0
+            st["threads"] = sorted(st["threads"])
+        return stages
+
+    def report(self):
+        """Returns the summary() as a table, with the slowest stages first. Stages that ran outside the
+        main thread are marked with a *, since their time overlaps that of other stages.
+        """
+        stages = sorted(self.summary().items(), key=lambda item: -item[1]["time"])
+        mb = lambda nbytes: "-" if nbytes is None else "%0.1f"%(nbytes / 2.0**20)
+        lines = ["%-16s %8s %12s %14s %10s %13s %12s"%("stage", "count", "time (s)", "FLOPs", "GFLOP/s",
+                                                     "peak RSS (MB)", "growth (MB)")]
+        for name, st in stages:
+            if st["threads"] != [threading.main_thread().name]:
+                name += "*"
+            lines.append("%-16s %8d %12.4f %14.4g %10.2f %13s %12s"%(name, st["count"], st["time"],
+                                                                       st["flops"], st["gflops"],
+                                                                       mb(st["peak_rss"]), mb(st["rss_growth"])))
+        if any(st["threads"] != [threading.main_thread().name] for name, st in stages):
+            lines.append("* ran in a background thread, overlapping the other stages")
+        return "\n".join(lines)
+
+_active_profiles = [] ## StageProfiles that are recording, see profile_stages
+
+import contextlib
+@contextlib.contextmanager
+def profile_stages(callback=None):
+    """Records every stage() run in this context into a new StageProfile, which is yielded. [callback]
+    is passed on to the StageProfile. The ridge functions record their factorizations ("svd", "eigh",
+    "kernel", "gram"), the UR and PVh products, the per-alpha "prediction" and "scoring" of each voxel
+    block, and the final "weights" fit, e.g.:
+
+        with profile_stages() as prof:
+            bootstrap_ridge(...)
+        print (prof.report())
+
+    Only stages run in this process are recorded, so bootstrap samples run in worker processes
+    (n_jobs > 1) are not.
+    """
+    prof = StageProfile(callback)
+    _active_profiles.append(prof)
+    try:
+        yield prof
+    finally:
+        _active_profiles.remove(prof)
+
+@contextlib.contextmanager
+def stage(name, flops=None):
+    """Times the code run in this context as a stage called [name] that does about [flops]
+    floating-point operations, and records it in every active StageProfile. Does nothing if no
+    profile is active.
+    """
+    if not _active_profiles:
+        yield
+        return
+    start_rss = peak_rss()
+    start_time = time.time()
+    yield
+    seconds = time.time() - start_time
+    for prof in list(_active_profiles):
+        prof.add(name, seconds, flops, start_rss)
+
+def staged(name, func, flops_per_column=None):
+    """Wraps [func], which takes a slice of columns (see voxel_blocks), so that each call is recorded
+    as a stage() called [name] that does [flops_per_column] FLOPs for each column in the slice.
+    """
+    def staged_func(cols):
+        flops = None if flops_per_column is None else flops_per_column * (cols.stop - cols.start)
+        with stage(name, flops):
+            return func(cols)
+    return staged_func
+
+
 def wait_for_disk(dir, maxtime=0.2, retrytime=10.0, maxtries=100):
     """Waits to continue until disk is not slammed.
     """
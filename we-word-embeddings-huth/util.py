@@ -90,12 +90,35 @@ def find_best_stims_for_word(wordvector, decstims, n):
     scorrs[np.isnan(scorrs)] = -1
     return np.argsort(scorrs)[-n:][::-1]
 
-def princomp(x, use_dgesvd=False):
+def princomp(x, use_dgesvd=False, method="svd", npcs=None, chunk=4096, seed=0):
     """Does principal components analysis on [x].
     Returns coefficients, scores and latent variable values.
     Translated from MATLAB princomp function.  Unlike the matlab princomp function, however, the
     rows of the returned value 'coeff' are the principal components, not the columns.
+    
+    [method] "svd" takes the SVD of the centered [x]. "incremental" instead accumulates the covariance
+    of [x] in blocks of [chunk] rows (see StreamingCov), so [x] is never centered or copied and can be
+    an np.memmap larger than memory. "randomized" finds the top [npcs] components with a randomized SVD
+    of the implicitly centered [x] (see ridge_utils.randomized_svd, with [seed]). If [npcs] is given
+    only that many components are returned. The signs of the components may differ between methods
+    (see fixPCs).
     """
+    if method == "incremental":
+        acc = StreamingCov()
+        for start in range(0, x.shape[0], chunk):
+            acc.update(x[start:start+chunk])
+        coeff, latent = acc.eig(npcs)
+        return coeff, acc.scores(x, coeff, chunk), np.diag(latent)
+    elif method == "randomized":
+        from ridge_utils import randomized_svd
+        if npcs is None:
+            raise ValueError("The randomized method needs npcs.")
+        mean = x.mean(0)
+        U, sigma, coeff = randomized_svd(x, npcs, seed=seed, center=mean)
+        score = np.dot(x, coeff.T) - np.dot(mean, coeff.T)
+        return coeff, score, np.diag(sigma**2 / (x.shape[0]-1))
+    elif method != "svd":
+        raise ValueError("Unknown method %r, should be 'svd', 'incremental' or 'randomized'." % (method,))
     
     n,p = x.shape
     #cx = x-np.tile(x.mean(0), (n,1)) ## column-centered x
@@ -108,6 +131,8 @@ def princomp(x, use_dgesvd=False):
     else:
         U,sigma,coeff = np.linalg.svd(cx, full_matrices=False)
     
+    if npcs is not None:
+        sigma, coeff = sigma[:npcs], coeff[:npcs]
     sigma = np.diag(sigma)
     score = np.dot(cx, coeff.T)
     sigma = sigma/np.sqrt(n-1)
@@ -116,40 +141,107 @@ def princomp(x, use_dgesvd=False):
 
     return coeff, score, latent
 
-def eigprincomp(x, npcs=None, norm=False, weights=None):
+def eigprincomp(x, npcs=None, norm=False, weights=None, chunk=4096):
     """Does principal components analysis on [x].
     Returns coefficients (eigenvectors) and eigenvalues.
     If given, only the [npcs] greatest eigenvectors/values will be returned.
     If given, the covariance matrix will be computed using [weights] on the samples.
+    The covariance is accumulated [chunk] rows at a time (see StreamingCov), so [x] is never
+    centered or copied.
     """
-    n,p = x.shape
-    #cx = x-np.tile(x.mean(0), (n,1)) ## column-centered x
-    cx = x-x.mean(0)
-    r = np.min([n-1,p]) ## maximum possible rank of cx
-    
-    xcov = np.cov(cx.T)
-    if norm:
-        xcov /= n
-    
-    if npcs is not None:
-        latent,coeff = scipy.linalg.eigh(xcov, eigvals=(p-npcs,p-1))
-    else:
-        latent,coeff = np.linalg.eigh(xcov)
-    
-    ## Transpose coeff, reverse its rows
-    return coeff.T[::-1], latent[::-1]
+    acc = StreamingCov()
+    for start in range(0, x.shape[0], chunk):
+        acc.update(x[start:start+chunk], None if weights is None else weights[start:start+chunk])
+    return acc.eig(npcs, norm)
 
-def weighted_cov(x, weights=None):
+def weighted_cov(x, weights=None, chunk=4096):
     """If given [weights], the covariance will be computed using those weights on the samples.
     Otherwise the simple covariance will be returned.
+    The samples (columns of [x]) are accumulated [chunk] at a time (see StreamingCov).
     """
-    if weights is None:
-        return np.cov(x)
-    else:
-        w = weights/weights.sum() ## Normalize the weights
-        dmx = (x.T-(w*x).sum(1)).T ## Subtract the WEIGHTED mean
-        wfact = 1/(1-(w**2).sum()) ## Compute the weighting factor
-        return wfact*np.dot(w*dmx, dmx.T.conj()) ## Take the weighted inner product
+    acc = StreamingCov()
+    for start in range(0, x.shape[1], chunk):
+        acc.update(x[:,start:start+chunk].T, None if weights is None else weights[start:start+chunk])
+    return acc.cov
+
+class StreamingCov(object):
+    """Accumulates the (optionally weighted) mean and covariance of data that arrive in blocks of rows
+    (samples), so that the data never has to be held in memory or centered as a whole. Each block is
+    merged into the running mean and sum of centered outer products (Chan et al.'s pairwise update),
+    which costs O(rows x features^2) and stays accurate when the mean is large.
+    
+    With sample weights w, the covariance is the same as weighted_cov on the concatenated data:
+    sum(w d d.T) / (W - sum(w^2) / W), where W = sum(w) and d are the deviations from the weighted
+    mean. Without weights this is the usual covariance with n-1 in the denominator, as np.cov.
+    """
+    def __init__(self):
+        """Initializes an empty accumulator.
+        """
+        self.mean = None ## weighted mean of each feature, (p,)
+        self.scatter = None ## weighted sum of centered outer products, (p x p)
+        self.wsum = 0.0 ## sum of the weights
+        self.wsqsum = 0.0 ## sum of the squared weights
+        self.nsamples = 0
+    
+    def update(self, x, weights=None):
+        """Folds the samples in the rows of [x] (n x p) into the accumulator, with the sample [weights]
+        (n,) if they are given.
+        """
+        x = np.asarray(x)
+        if weights is None:
+            weights = np.ones((x.shape[0],))
+        weights = np.asarray(weights, dtype=float)
+        bwsum = weights.sum()
+        if bwsum == 0:
+            return
+        bmean = np.dot(weights, x) / bwsum
+        dx = x - bmean
+        bscatter = np.dot((weights[:,None] * dx).T, dx.conj())
+        
+        if self.mean is None:
+            self.mean, self.scatter = bmean, bscatter
+        else:
+            ## Combine the two sets of centered outer products around the new mean
+            delta = bmean - self.mean
+            total = self.wsum + bwsum
+            self.scatter = self.scatter + bscatter + np.outer(delta, delta.conj()) * (self.wsum * bwsum / total)
+            self.mean = self.mean + delta * (bwsum / total)
+        self.wsum += bwsum
+        self.wsqsum += (weights**2).sum()
+        self.nsamples += x.shape[0]
+    
+    def get_cov(self):
+        """Returns the (p x p) covariance of the samples seen so far.
+        """
+        if self.mean is None:
+            raise ValueError("No samples have been accumulated.")
+        return self.scatter / (self.wsum - self.wsqsum / self.wsum)
+    cov = property(get_cov)
+    
+    def eig(self, npcs=None, norm=False):
+        """Returns the eigenvectors (as rows) and eigenvalues of the covariance, largest first, like
+        eigprincomp. If [npcs] is given only that many are returned. If [norm], the covariance is divided
+        by the number of samples first.
+        """
+        xcov = self.cov
+        if norm:
+            xcov = xcov / self.nsamples
+        p = xcov.shape[0]
+        if npcs is not None:
+            latent,coeff = scipy.linalg.eigh(xcov, subset_by_index=(p-npcs,p-1))
+        else:
+            latent,coeff = np.linalg.eigh(xcov)
+        return coeff.T[::-1], latent[::-1]
+    
+    def scores(self, x, coeff, chunk=4096):
+        """Returns the projections of the rows of [x] (n x p), centered by the accumulated mean, onto the
+        components in the rows of [coeff], computed [chunk] rows at a time.
+        """
+        offset = np.dot(self.mean, coeff.T)
+        score = np.empty((x.shape[0], coeff.shape[0]), dtype=np.result_type(x.dtype, coeff.dtype))
+        for start in range(0, x.shape[0], chunk):
+            score[start:start+chunk] = np.dot(x[start:start+chunk], coeff.T) - offset
+        return score
 
 def test_weighted_cov():
     """Runs a test on the weighted_cov function, creating a dataset for which the covariance is known